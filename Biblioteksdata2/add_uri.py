@@ -3,15 +3,30 @@
 import argparse
 import json
 import logging
+import os
+import sys
 import pywikibot
 import pywikibot.data.sparql as sparql
-import requests
 from requests.exceptions import ConnectionError
-from pywikibot.exceptions import OtherPageSaveError
+from pywikibot.exceptions import (APIError, MaxlagTimeoutError,
+                                  OtherPageSaveError)
 import time
 from datetime import date
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "shared"))
+import http_cache  # noqa: E402
+import thread_pool  # noqa: E402
+import upload_journal  # noqa: E402
+
 SLEEP_LENGTH = 10
+MIN_SLEEP_LENGTH = 1
+MAX_SLEEP_LENGTH = 300
+SPEEDUP = 0.9
+MAXLAG = 5
+RATE_LIMIT_ERRORS = ["ratelimited", "maxlag"]
+PREFETCH_WORKERS = 4
+CHECK_BATCH_SIZE = 50
 
 LIBRIS_API = {"authorities": "https://libris.kb.se/auth/{}",
               "editions": "https://libris.kb.se/resource/bib/{}"}
@@ -28,6 +43,36 @@ WIKIDATA = {"libris_uri": "P5587",
             "reference_url": "P854"}
 
 
+class RateController(object):
+    """
+    Adapt the pause between edits to the state of Wikidata.
+
+    Starts at SLEEP_LENGTH seconds and shortens the pause
+    after every successful edit. Replication lag is left to
+    pywikibot: edits are sent with maxlag=MAXLAG, and while
+    Wikidata is lagging pywikibot waits as long as the
+    Retry-After header asks and tries again. If it gives up
+    (MaxlagTimeoutError), or the edit is rate limited, the
+    pause is doubled. Nothing is paused when not running
+    live.
+    """
+
+    def __init__(self, live):
+        self.live = live
+        self.delay = SLEEP_LENGTH
+
+    def success(self):
+        self.delay = max(MIN_SLEEP_LENGTH, self.delay * SPEEDUP)
+
+    def backoff(self):
+        self.delay = min(MAX_SLEEP_LENGTH, self.delay * 2)
+
+    def wait(self):
+        """Pause before an edit."""
+        if self.live:
+            time.sleep(self.delay)
+
+
 def get_query(query_name):
     with open('{}.rq'.format(query_name)) as query_file:
         logging.info("Loaded query file: {}".format(query_name))
@@ -62,56 +107,118 @@ def retrieve_libris_data(librised, query_type):
     address = LIBRIS_API[query_type].format(librised)
     headers = {'Accept': 'application/json'}
     logging.info("Retrieving data from {}.".format(address))
-    libris_content = json.loads(requests.get(address, headers=headers).text)
+    libris_content = json.loads(http_cache.get_text(address, headers))
     uri = extract_uri(libris_content)
     modified_date = extract_modified_date(libris_content)
     url = LIBRIS_URL.format(uri)
     return {"uri": uri, "published": modified_date, "url": url}
 
 
-def has_claim(property, itempage):
-    claims = itempage.get('claims')
-    return property in claims['claims']
+def prefetch_libris_data(candidates, query_type, workers=PREFETCH_WORKERS,
+                         window=CHECK_BATCH_SIZE):
+    """
+    Retrieve Libris data of upcoming candidates in the background.
+
+    A pool of workers keeps fetching ahead of the uploads.
+    At most window candidates are submitted but not yet
+    yielded, so memory stays bounded. Every candidate that
+    is yielded makes room for one more. The uploads take
+    CHECK_BATCH_SIZE candidates at a time, so with the
+    default window exactly the next batch is being fetched
+    while the current one is uploaded.
+
+    Yields (qid, librised, future) in the order of the
+    candidates. The future gives the processed Libris post
+    or raises the retrieval error.
+    """
+    def retrieve(candidate):
+        return retrieve_libris_data(candidate[1], query_type)
+    for (qid, librised), future in thread_pool.ordered_map(
+            retrieve, candidates, workers, window):
+        yield qid, librised, future
+
+
+def get_entities(repo, qids):
+    """
+    Get the claims and last revision id of items.
 
+    All the items (at most CHECK_BATCH_SIZE) are fetched
+    with a single wbgetentities call. Returns a dict of
+    qid → entity data.
+    """
+    if not qids:
+        return {}
+    request = repo.simple_request(action="wbgetentities",
+                                  ids="|".join(qids),
+                                  props="claims|info")
+    return request.submit().get("entities", {})
 
-def upload_uri(qid, processed_libris_post, query_type):
+
+def journal_content(librised):
+    """What the journal records about a URI edit."""
+    return {"property": WIKIDATA["libris_uri"], "librised": librised}
+
+
+def in_batches(iterable, size):
+    batch = []
+    for element in iterable:
+        batch.append(element)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def upload_uri(repo, entity, processed_libris_post, query_type):
+    """
+    Add Libris URI claim to an item, unless it has one.
+
+    The item is loaded from the entity data of the batch
+    check (get_entities), the way repo.preload_entities
+    does, instead of being requested again. The edit is
+    based on the revision seen in the batch check.
+
+    Returns False if the item already had a URI.
+    """
     # qid = "Q4115189"
     uri = processed_libris_post["uri"]
     published = processed_libris_post["published"]
     website = processed_libris_post["url"]
-    site = pywikibot.Site("wikidata", "wikidata")
-    repo = site.data_repository()
-    item = pywikibot.ItemPage(repo, qid)
+    item = pywikibot.ItemPage(repo, entity["id"])
+    item._content = entity
+    item.get()
+    if WIKIDATA["libris_uri"] in item.claims:
+        return False
     today = date.today()
-    # check immediately before adding
-    if not has_claim(WIKIDATA["libris_uri"], item):
-        uri_claim = pywikibot.Claim(repo, WIKIDATA["libris_uri"])
-        uri_claim.setTarget(uri)
+    uri_claim = pywikibot.Claim(repo, WIKIDATA["libris_uri"])
+    uri_claim.setTarget(uri)
 
-        published_claim = pywikibot.Claim(repo, WIKIDATA["published"])
-        published_date = pywikibot.WbTime(year=published["year"],
-                                          month=published["month"],
-                                          day=published["day"])
-        published_claim.setTarget(published_date)
+    published_claim = pywikibot.Claim(repo, WIKIDATA["published"])
+    published_date = pywikibot.WbTime(year=published["year"],
+                                      month=published["month"],
+                                      day=published["day"])
+    published_claim.setTarget(published_date)
 
-        stated_in_claim = pywikibot.Claim(repo, WIKIDATA["stated_in"])
-        stated_in_claim.setTarget(pywikibot.ItemPage(repo, WIKIDATA["libris"]))
+    stated_in_claim = pywikibot.Claim(repo, WIKIDATA["stated_in"])
+    stated_in_claim.setTarget(pywikibot.ItemPage(repo, WIKIDATA["libris"]))
 
-        website_claim = pywikibot.Claim(repo, WIKIDATA["reference_url"])
-        website_claim.setTarget(website)
+    website_claim = pywikibot.Claim(repo, WIKIDATA["reference_url"])
+    website_claim.setTarget(website)
 
-        retrieved_date = pywikibot.WbTime(year=today.year,
-                                          month=today.month,
-                                          day=today.day)
-        retrieved_claim = pywikibot.Claim(repo, 'P813')
-        retrieved_claim.setTarget(retrieved_date)
+    retrieved_date = pywikibot.WbTime(year=today.year,
+                                      month=today.month,
+                                      day=today.day)
+    retrieved_claim = pywikibot.Claim(repo, 'P813')
+    retrieved_claim.setTarget(retrieved_date)
 
-        uri_claim.addSources([stated_in_claim,
-                              website_claim,
-                              published_claim,
-                              retrieved_claim])
-        logging.info("Uploading {} {} to {}.".format("URI", uri, qid))
-        item.addClaim(uri_claim, summary=EDIT_SUMMARY)
+    uri_claim.addSources([stated_in_claim,
+                          website_claim,
+                          published_claim,
+                          retrieved_claim])
+    logging.info("Uploading {} {} to {}.".format("URI", uri, qid))
+    item.addClaim(uri_claim, summary=EDIT_SUMMARY)
+    return True
 
 
 def main(arguments):
@@ -123,31 +230,72 @@ def main(arguments):
                         format='%(asctime)s;%(levelname)s;%(message)s',
                         datefmt='%H:%M:%S',
                         level=logging.INFO)
+    rate = RateController(arguments.get("live"))
+    pywikibot.config.maxlag = MAXLAG
+    site = pywikibot.Site("wikidata", "wikidata")
+    repo = site.data_repository()
+    journal = upload_journal.get_journal()
     for query_type in QUERIES:
-        candidates = get_candidates(query_type)
-        for candidate in candidates:
-            qid = candidate[0]
-            librised = candidate[1]
-            try:
-                processed_libris_post = retrieve_libris_data(librised,
-                                                             query_type)
-            except (ValueError, ConnectionError) as e:
-                logging.error(
-                    "Couldn't process Libris ID {} (in {}).".format(librised,
-                                                                    qid))
-                logging.error(e)
-                continue
+        candidates = [(qid, librised) for qid, librised
+                      in get_candidates(query_type)
+                      if not journal.done(librised,
+                                          journal_content(librised), qid)]
+        logging.info("{}: {} candidates left after journal.".format(
+            query_type, len(candidates)))
+        prefetched = prefetch_libris_data(
+            candidates, query_type,
+            arguments.get("workers") or PREFETCH_WORKERS)
+        for batch in in_batches(prefetched, CHECK_BATCH_SIZE):
+            # skip items that already have a URI without pausing
+            entities = {}
             if arguments.get("live"):
+                entities = get_entities(repo, [x[0] for x in batch])
+            for qid, librised, libris_data in batch:
                 try:
-                    upload_uri(qid, processed_libris_post, query_type)
-                except OtherPageSaveError as e:
-                    logging.error("Couldn't save edit in {}.".format(qid))
+                    processed_libris_post = libris_data.result()
+                except (ValueError, ConnectionError) as e:
+                    logging.error(
+                        "Couldn't process Libris ID {} (in {}).".format(
+                            librised, qid))
                     logging.error(e)
-            time.sleep(SLEEP_LENGTH)
+                    continue
+                entity = entities.get(qid, {})
+                if WIKIDATA["libris_uri"] in entity.get("claims", {}):
+                    logging.info("{} already has URI.".format(qid))
+                    journal.record("add_uri", librised, qid,
+                                   journal_content(librised))
+                    continue
+                if arguments.get("live"):
+                    if "lastrevid" not in entity:
+                        logging.error("Couldn't load {}.".format(qid))
+                        continue
+                    rate.wait()
+                    try:
+                        if upload_uri(repo, entity, processed_libris_post,
+                                      query_type):
+                            rate.success()
+                        else:
+                            logging.info("{} already has URI.".format(qid))
+                        journal.record("add_uri", librised, qid,
+                                       journal_content(librised))
+                    except MaxlagTimeoutError as e:
+                        logging.error("Couldn't save edit in {}.".format(qid))
+                        logging.error(e)
+                        rate.backoff()
+                    except APIError as e:
+                        if e.code not in RATE_LIMIT_ERRORS:
+                            raise
+                        logging.error("Couldn't save edit in {}.".format(qid))
+                        logging.error(e)
+                        rate.backoff()
+                    except OtherPageSaveError as e:
+                        logging.error("Couldn't save edit in {}.".format(qid))
+                        logging.error(e)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--live", action='store_true')
+    parser.add_argument("--workers", type=int, default=PREFETCH_WORKERS)
     args = parser.parse_args()
     main(vars(args))
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""Compare harvester.process_data with the separate get_* functions.
+
+Checks that both give byte-identical output and times them
+on a set of raw Libris editions, e.g. a re-processed dump.
+
+Usage:
+    --path FILENAME   json file with a list of raw Libris
+                      editions, or a JSON Lines file with one
+                      edition per line. Without it, a built-in
+                      sample edition is used.
+    --repeat N        number of passes over the data (default: 1000)
+"""
+import argparse
+import json
+import timeit
+
+import harvester
+
+SAMPLE = {
+    "@id": "https://libris.kb.se/fnrbrgl4qr0hhwj#it",
+    "controlNumber": "12345678",
+    "modified": "2019-03-01T12:00:00.0+01:00",
+    "bibliography": [{"@type": "Library", "sigel": "NB"}],
+    "mainEntity": {
+        "identifiedBy": [
+            {"@type": "ISSN", "value": "0000-0000"},
+            {"@type": "ISBN", "value": "9789100000000",
+             "qualifier": [["inbunden"]]},
+            {"@type": "ISBN", "value": "9100000000"}],
+        "hasTitle": [
+            {"@type": "VariantTitle", "mainTitle": "Variant"},
+            {"@type": "Title", "mainTitle": "Huvudtitel",
+             "subtitle": "en undertitel"}],
+        "extent": [{"@type": "Extent", "label": [["317 s."]]}],
+        "publication": [
+            {"@type": "Publication", "year": "2001"},
+            {"@type": "PrimaryPublication", "year": "2000",
+             "agent": {"@type": "Agent", "label": [["Bonnier"]]},
+             "place": [{"@type": "Place", "label": ["Stockholm"]}]}],
+        "instanceOf": {
+            "language": [{"code": "swe"}],
+            "contribution": [
+                {"@type": "PrimaryContribution",
+                 "agent": {"@id": "https://libris.kb.se/abc#it",
+                           "givenName": "Selma",
+                           "familyName": "Lagerlöf"}},
+                {"@type": "Contribution",
+                 "role": [{"@id": "https://id.kb.se/relator/translator"}],
+                 "agent": {"givenName": "Anna", "familyName": "Ek"}},
+                {"@type": "Contribution",
+                 "role": [{"@id": "https://id.kb.se/relator/printer"}],
+                 "agent": {"givenName": "Per", "familyName": "Tryck"}}]}}}
+
+
+def process_data_with_getters(raw):
+    """
+    Simplify a Libris edition by calling each getter in turn.
+
+    This is how process_data used to work.
+
+    @param raw: json object of a Libris edition
+    @type raw: dictionary
+    """
+    clean = {}
+    clean["uri"] = harvester.get_uri(raw)
+    clean["libris_ed"] = harvester.get_libris_edition(raw) or ""
+    clean["bibliography"] = harvester.get_bibliography(raw)
+    clean["ISBN"] = harvester.get_isbn(raw) or ""
+    clean["publisher"] = harvester.get_publisher(raw) or ""
+    clean["publicationYear"] = harvester.get_publication_year(raw) or ""
+    clean["publicationPlace"] = harvester.get_publication_place(raw) or ""
+    clean["distributionFormat"] = (
+        harvester.get_distribution_format(raw) or "")
+    clean["title"] = harvester.get_title(raw)
+    clean["subtitle"] = harvester.get_subtitle(raw) or ""
+    clean["extent"] = harvester.get_extent(raw) or ""
+    clean["contributors"] = harvester.get_contributors(raw) or ""
+    clean["language"] = harvester.get_language(raw) or ""
+    clean["modified"] = harvester.get_modified(raw)
+    return clean
+
+
+def load_editions(filename):
+    """
+    Load raw editions from a json or JSON Lines file.
+
+    @param filename: file to load
+    @type filename: string
+    """
+    with open(filename) as fname:
+        text = fname.read()
+    try:
+        editions = json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line]
+    if isinstance(editions, dict):
+        return [editions]
+    return editions
+
+
+def serialize(clean):
+    """Serialize processed edition the way json_to_file does."""
+    return json.dumps(clean, indent=4, separators=(',', ': '),
+                      sort_keys=True)
+
+
+def main(args):
+    """Check output and time both implementations."""
+    if args.get("path"):
+        editions = load_editions(args["path"])
+    else:
+        editions = [SAMPLE]
+    for raw in editions:
+        if serialize(harvester.process_data(raw)) != serialize(
+                process_data_with_getters(raw)):
+            raise ValueError("Output differs for {}.".format(raw["@id"]))
+    print("Output identical for {} editions.".format(len(editions)))
+    repeat = args.get("repeat")
+    results = {}
+    for name, function in [("getters", process_data_with_getters),
+                           ("single pass", harvester.process_data)]:
+        results[name] = timeit.timeit(
+            lambda: [function(raw) for raw in editions], number=repeat)
+        print("{:<12} {:.3f} s for {} editions".format(
+            name, results[name], repeat * len(editions)))
+    print("Speedup: {:.2f}x".format(
+        results["getters"] / results["single pass"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path")
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+    main(vars(args))
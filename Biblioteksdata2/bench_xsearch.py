@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""Compare xsearch.permissive_json_loads with the old retry loop.
+
+Builds an xsearch page where many records contain
+unescaped backslashes (and some unescaped quotes),
+checks that both loaders give the same result and
+times them.
+
+Usage:
+    --records N   number of records on the page (default: 200)
+    --bad N       number of broken backslashes per record (default: 3)
+    --repeat N    number of times to parse the page (default: 3)
+"""
+import argparse
+import json
+import timeit
+
+import xsearch
+
+
+def retry_json_loads(text):
+    """
+    Load json by re-parsing after fixing each error.
+
+    This is how permissive_json_loads used to work.
+
+    @param text: text to parse as json
+    @type text: string
+    """
+    while True:
+        try:
+            data = json.loads(text)
+        except ValueError as exc:
+            if exc.msg == 'Invalid \\escape':
+                text = text[:exc.pos] + '\\' + text[exc.pos:]
+            elif exc.msg == "Expecting ',' delimiter":
+                text = text[:exc.pos - 1] + '\\' + text[exc.pos - 1:]
+            else:
+                raise
+        else:
+            return data
+
+
+def make_page(records, bad):
+    """
+    Build the text of a broken xsearch page.
+
+    @param records: number of records on the page
+    @type records: int
+    @param bad: number of broken backslashes per record
+    @type bad: int
+    """
+    items = []
+    for i in range(records):
+        title = " ".join(["C:\\dir{}\\file".format(j) for j in range(bad)])
+        if i % 10 == 0:
+            title += ' "citat" \\\\ ok \\n'
+        items.append(
+            '{{"identifier": "http://libris.kb.se/bib/{}", '
+            '"title": "{}", "publisher": "Förlag\\ AB"}}'.format(i, title))
+    return ('{{"xsearch": {{"from": 1, "to": {0}, "records": {0}, '
+            '"list": [{1}]}}}}'.format(records, ", ".join(items)))
+
+
+def main(args):
+    """Check output and time both implementations."""
+    page = make_page(args.get("records"), args.get("bad"))
+    if xsearch.permissive_json_loads(page) != retry_json_loads(page):
+        raise ValueError("Output differs.")
+    print("Output identical for page of {} characters.".format(len(page)))
+    repeat = args.get("repeat")
+    results = {}
+    for name, function in [("retry loop", retry_json_loads),
+                           ("single pass", xsearch.permissive_json_loads)]:
+        results[name] = timeit.timeit(lambda: function(page), number=repeat)
+        print("{:<12} {:.3f} s for {} pages".format(
+            name, results[name], repeat))
+    print("Speedup: {:.2f}x".format(
+        results["retry loop"] / results["single pass"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=200)
+    parser.add_argument("--bad", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(vars(args))
@@ -15,12 +15,68 @@ Usage:
     --out  FILENAME   specify filename to save the output,
                       otherwise default filename will be
                       used
+    --workers N       number of editions to download
+                      concurrently (default: 1, one at a time)
+    --per_host N      maximum number of simultaneous requests
+                      to a single host when using --workers
+    --jsonl           write one edition per line as it is
+                      processed (JSON Lines) instead of
+                      a single json file at the end
+    --resume          with --jsonl, skip editions that are
+                      already in the output file
 """
 import argparse
 import json
-import requests
+import os
+import sys
+import threading
+from urllib.parse import urlparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "shared"))
+import http_cache  # noqa: E402
+import thread_pool  # noqa: E402
 
 OUTPUT_FILE = "output.json"
+OUTPUT_FILE_JSONL = "output.jsonl"
+FLUSH_EVERY = 100
+WORKERS = 1
+PER_HOST = 4
+
+
+class HostLimiter(object):
+    """
+    Cap the number of simultaneous requests to each host.
+
+    Used by the concurrent harvest so that a large worker
+    pool does not hammer Libris with more connections
+    than it allows.
+    """
+
+    def __init__(self, per_host):
+        """
+        Initialize an empty limiter.
+
+        @param per_host: max number of simultaneous requests per host
+        @type per_host: int
+        """
+        self.per_host = per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def slot(self, url):
+        """
+        Get the semaphore guarding the host of an url.
+
+        @param url: url that is about to be requested
+        @type url: string
+        """
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.per_host)
+            return self.semaphores[host]
 
 
 def json_to_file(filename, content):
@@ -40,6 +96,91 @@ def json_to_file(filename, content):
     print("Saved {} objects to {}".format(len(content), filename))
 
 
+class JsonLinesWriter(object):
+    """
+    Write json objects to file, one per line.
+
+    The file is flushed regularly, so that
+    an interrupted harvest keeps what it has
+    processed so far.
+    """
+
+    def __init__(self, filename, append=False, flush_every=FLUSH_EVERY):
+        """
+        Open the output file.
+
+        @param filename: file to save to
+        @type filename: string
+        @param append: add to an existing file instead of overwriting it
+        @type append: bool
+        @param flush_every: number of objects between flushes
+        @type flush_every: int
+        """
+        self.filename = filename
+        self.flush_every = flush_every
+        self.count = 0
+        self.fname = open(filename, 'a' if append else 'w')
+
+    def write(self, content):
+        """
+        Write a single json object as a line.
+
+        @param content: content to save
+        @type content: dictionary
+        """
+        self.fname.write(json.dumps(content, sort_keys=True) + '\n')
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.fname.flush()
+            os.fsync(self.fname.fileno())
+
+    def close(self):
+        """Flush and close the output file."""
+        self.fname.close()
+        print("Saved {} objects to {}".format(self.count, self.filename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_processed_ids(filename):
+    """
+    Get identifiers of editions already saved in a JSON Lines file.
+
+    Both the URI and the old Edition ID of each saved
+    edition are returned, so that the input list can
+    use either. A last line that was only partly written
+    when the harvest was interrupted is cut off, so that
+    new lines can be appended safely.
+
+    @param filename: JSON Lines file written by a previous harvest
+    @type filename: string
+    """
+    processed = set()
+    if not os.path.exists(filename):
+        return processed
+    complete = 0
+    with open(filename, 'rb') as fname:
+        for line in fname:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                edition = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            processed.add(edition["uri"])
+            if edition.get("libris_ed"):
+                processed.add(edition["libris_ed"])
+            complete += len(line)
+    if complete < os.path.getsize(filename):
+        with open(filename, 'r+b') as fname:
+            fname.truncate(complete)
+    return processed
+
+
 def is_libris_edition_id(identifier):
     """
     Check if identifier is old-format Libris ID.
@@ -78,20 +219,49 @@ def file_to_list(some_file):
         return fname.read().splitlines()
 
 
-def get_from_id(identifier):
+def get_from_id(identifier, limiter=None):
     """
     Load data from edition id or uri.
 
     @param identifier: edition identifier (old or URI)
     @type identifier: string
+    @param limiter: optional per-host request ceiling
+    @type limiter: HostLimiter
     """
     if is_libris_edition_id(identifier):
         url = "http://libris.kb.se/resource/bib/{}"
     else:
         url = "https://libris.kb.se/{}"
+    url = url.format(identifier)
     headers = {'Accept': 'application/json'}
-    return json.loads(requests.get(url.format(identifier),
-                                   headers=headers).text)
+    if limiter:
+        with limiter.slot(url):
+            return json.loads(http_cache.get_text(url, headers))
+    return json.loads(http_cache.get_text(url, headers))
+
+
+def get_concurrently(identifiers, workers, per_host):
+    """
+    Load data of several editions using a pool of workers.
+
+    Downloads overlap, but the records are yielded
+    in the same order as the identifiers, as soon as
+    each of them is available. Only a limited window
+    of downloads is kept in flight, so memory use
+    does not grow with the length of the list.
+
+    @param identifiers: edition identifiers (old or URI)
+    @type identifiers: list
+    @param workers: number of simultaneous downloads
+    @type workers: int
+    @param per_host: max number of simultaneous requests per host
+    @type per_host: int
+    """
+    limiter = HostLimiter(per_host)
+    for _, future in thread_pool.ordered_map(
+            lambda identifier: get_from_id(identifier, limiter),
+            identifiers, workers, workers * 2):
+        yield future.result()
 
 
 def get_bibliography(raw):
@@ -248,11 +418,21 @@ def get_contributors(raw):
     @param raw: json object of a Libris edition
     @type raw: dictionary
     """
+    return extract_contributors(
+        raw["mainEntity"]["instanceOf"].get("contribution"))
+
+
+def extract_contributors(contribution):
+    """
+    Sort contributors by role.
+
+    @param contribution: contribution list of a Libris work
+    @type contribution: list
+    """
     valid_roles = ["author", "editor",
                    "translator", "illustrator"]
     agents = {"author": [], "editor": [],
               "translator": [], "illustrator": []}
-    contribution = raw["mainEntity"]["instanceOf"].get("contribution")
     for agent in contribution:
         raw_role = agent.get("role")
         if not raw_role:
@@ -311,23 +491,64 @@ def process_data(raw):
     Gets rid of the data that is not needed
     and simplifies the needed parts.
 
+    Gives the same result as combining the get_*
+    functions above, but each list in the record
+    (identifiers, titles, publications...) is only
+    filtered once and shared by all the fields that
+    need it. See bench_harvester.py.
+
     @param raw: json object of a Libris edition
     @type raw: dictionary
     """
+    main_entity = raw["mainEntity"]
+    work = main_entity["instanceOf"]
+
+    isbn = None
+    distribution_format = None
+    identified_by = main_entity.get("identifiedBy")
+    if identified_by:
+        first_isbn = [x for x in identified_by
+                      if x["@type"].lower() == "isbn"][0]
+        isbn = first_isbn["value"]
+        if first_isbn.get("qualifier"):
+            distribution_format = delistify(first_isbn["qualifier"])
+
+    publisher = None
+    publication_year = None
+    publication_place = None
+    primary = [x for x in main_entity.get("publication") if
+               x["@type"] == "PrimaryPublication"]
+    if primary:
+        publisher = delistify(primary[0]["agent"]["label"])
+        publication_year = primary[0]["year"]
+        place = primary[0]["place"]
+        if isinstance(place, list):
+            publication_place = delistify([x["label"] for x in place if
+                                           x["@type"] == "Place"])
+        else:
+            publication_place = delistify(place.get("label"))
+
+    title = [x for x in main_entity.get("hasTitle") if
+             x["@type"] == "Title"][0]
+    extent = [x["label"] for x in main_entity.get("extent") if
+              x["@type"] == "Extent"][0]
+    language = work.get("language")
+
     clean = {}
     clean["uri"] = get_uri(raw)
     clean["libris_ed"] = get_libris_edition(raw) or ""
     clean["bibliography"] = get_bibliography(raw)
-    clean["ISBN"] = get_isbn(raw) or ""
-    clean["publisher"] = get_publisher(raw) or ""
-    clean["publicationYear"] = get_publication_year(raw) or ""
-    clean["publicationPlace"] = get_publication_place(raw) or ""
-    clean["distributionFormat"] = get_distribution_format(raw) or ""
-    clean["title"] = get_title(raw)
-    clean["subtitle"] = get_subtitle(raw) or ""
-    clean["extent"] = get_extent(raw) or ""
-    clean["contributors"] = get_contributors(raw) or ""
-    clean["language"] = get_language(raw) or ""
+    clean["ISBN"] = isbn or ""
+    clean["publisher"] = publisher or ""
+    clean["publicationYear"] = publication_year or ""
+    clean["publicationPlace"] = publication_place or ""
+    clean["distributionFormat"] = distribution_format or ""
+    clean["title"] = title.get("mainTitle")
+    clean["subtitle"] = title.get("subtitle") or ""
+    clean["extent"] = delistify(extent) or ""
+    clean["contributors"] = extract_contributors(
+        work.get("contribution")) or ""
+    clean["language"] = (language and language[0]["code"]) or ""
     clean["modified"] = get_modified(raw)
     return clean
 
@@ -339,13 +560,34 @@ def main(args):
         to_process = file_to_list(args.get("list"))
     elif args.get("book"):
         to_process = [args.get("book")]
+    if args.get("jsonl"):
+        extension, default_filename = "jsonl", OUTPUT_FILE_JSONL
+    else:
+        extension, default_filename = "json", OUTPUT_FILE
     if args.get("out"):
-        filename = "{}.json".format(args.get("out"))
+        filename = "{}.{}".format(args.get("out"), extension)
     else:
-        filename = OUTPUT_FILE
+        filename = default_filename
+    if args.get("resume"):
+        processed = get_processed_ids(filename)
+        original_len = len(to_process)
+        to_process = [x for x in to_process if x not in processed]
+        print("Skipping {} editions already in {}.".format(
+            original_len - len(to_process), filename))
+    workers = args.get("workers") or WORKERS
     print("Ready to process {} editions.".format(len(to_process)))
-    for i, book_id in enumerate(to_process):
-        raw_data = get_from_id(book_id)
+    if workers > 1:
+        raw_records = get_concurrently(to_process, workers,
+                                       args.get("per_host") or PER_HOST)
+    else:
+        raw_records = (get_from_id(book_id) for book_id in to_process)
+    if args.get("jsonl"):
+        with JsonLinesWriter(filename, append=args.get("resume")) as writer:
+            for i, raw_data in enumerate(raw_records):
+                writer.write(process_data(raw_data))
+                print("Processed {}/{}.".format(i + 1, len(to_process)))
+        return
+    for i, raw_data in enumerate(raw_records):
         output.append(process_data(raw_data))
         print("Processed {}/{}.".format(i + 1, len(to_process)))
     json_to_file(filename, output)
@@ -360,5 +602,17 @@ if __name__ == "__main__":
                       or URI allowed), one per line")
     parser.add_argument("--out", help="specify filename to save the output, \
                       otherwise default filename will be used")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="number of editions to download concurrently")
+    parser.add_argument("--per_host", type=int, default=PER_HOST,
+                        help="maximum number of simultaneous requests \
+                        to a single host")
+    parser.add_argument("--jsonl", action="store_true",
+                        help="write one edition per line as they are \
+                        processed")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip editions already in the --jsonl output")
     args = parser.parse_args()
+    if args.resume and not args.jsonl:
+        parser.error("--resume can only be used with --jsonl")
     main(vars(args))
@@ -1,12 +1,33 @@
 #!/usr/bin/python
 # -*- coding: utf-8  -*-
 import argparse
+import bz2
+import csv
+import gzip
+import lzma
+import mmap
+import os
 import random
-import utils
+import sqlite3
+import sys
+from multiprocessing import Pool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "shared"))
+import snapshot_cache  # noqa: E402
+import upload_journal  # noqa: E402
+import utils  # noqa: E402
+import wdqs_pages  # noqa: E402
 
 PROPERTIES = {"viaf": "P214",
               "selibr": "P906"}
 
+BATCH_SIZE = 10000
+SELIBR_MARKER = b"\tSELIBR|"
+COMPRESSED = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+CROSSWALK_FILE = "crosswalk.tsv"
+CROSSWALK_COLUMNS = ["action", "item", "property", "value", "note"]
+
 
 def make_editgroups_summary(basetext):
     randomhash = "{:x}".format(random.randrange(0, 2**48))
@@ -26,42 +47,377 @@ def get_humans_with_viaf_no_selibr():
     return utils.run_query("get_humans_with_viaf_no_selibr.rq")
 
 
+def get_humans_by_value(prop):
+    """
+    Get a value → set of items map of all humans with a property.
+
+    There are millions of these, more than a single WDQS
+    query can return before it times out, so they are
+    downloaded in pages and kept as a snapshot (see
+    wdqs_pages and snapshot_cache).
+    """
+    pattern = "?item wdt:P31 wd:Q5; wdt:{} ?value.".format(prop)
+    return snapshot_cache.load(
+        "humans_{}".format(prop),
+        lambda: wdqs_pages.get_items_by_value(pattern))
+
+
+class LinksIndex(object):
+    """
+    On-disk index of the SELIBR links in a VIAF dump.
+
+    Built once from the multi-gigabyte links file with
+    the index action; afterwards VIAF ID's can be looked up
+    by SELIBR and the other way round without scanning
+    the dump.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS links "
+                        "(viaf TEXT, selibr TEXT)")
+
+    def build(self, viaf_file, processes=1):
+        """Replace the index content with the SELIBR lines of a dump."""
+        self.db.execute("DROP INDEX IF EXISTS links_viaf")
+        self.db.execute("DROP INDEX IF EXISTS links_selibr")
+        self.db.execute("DELETE FROM links")
+        batch = []
+        count = 0
+        for viaf, selibr in scan_selibr_lines(viaf_file, processes):
+            batch.append((viaf, selibr))
+            if len(batch) == BATCH_SIZE:
+                self.db.executemany("INSERT INTO links VALUES (?, ?)", batch)
+                count += len(batch)
+                batch = []
+        self.db.executemany("INSERT INTO links VALUES (?, ?)", batch)
+        count += len(batch)
+        self.db.execute("CREATE INDEX links_viaf ON links (viaf)")
+        self.db.execute("CREATE INDEX links_selibr ON links (selibr)")
+        self.db.commit()
+        return count
+
+    def pairs(self):
+        return iter(self.db.execute("SELECT viaf, selibr FROM links"))
+
+    def viaf_for_selibr(self, selibr):
+        return [x[0] for x in self.db.execute(
+            "SELECT viaf FROM links WHERE selibr = ?", (selibr,))]
+
+    def selibr_for_viaf(self, viaf):
+        return [x[0] for x in self.db.execute(
+            "SELECT selibr FROM links WHERE viaf = ?", (viaf,))]
+
+
 def main(args):
-    viaf_file = args.path
-    if args.action == "add_viaf_from_selibr":
-        add_viaf_from_selibr(viaf_file, args.upload)
+    if args.action == "index":
+        index_path = args.index or "{}.sqlite".format(args.path)
+        count = LinksIndex(index_path).build(args.path, args.processes)
+        print("Indexed {} SELIBR links in {}.".format(count, index_path))
+        return
+    if args.index:
+        links = LinksIndex(args.index)
+    else:
+        links = args.path
+    if args.action == "upload_crosswalk":
+        upload_crosswalk(args.table, args.upload)
+    elif args.action == "crosswalk":
+        build_crosswalk(links, args.table, args.processes)
+    elif args.action == "add_viaf_from_selibr":
+        add_viaf_from_selibr(links, args.upload, args.processes)
     elif args.action == "add_selibr_from_viaf":
-        add_selibr_from_viaf(viaf_file, args.upload)
+        add_selibr_from_viaf(links, args.upload, args.processes)
+
 
+def iter_links(links, processes=1):
+    """Yield (VIAF, SELIBR) pairs from a links index or a dump."""
+    if isinstance(links, LinksIndex):
+        return links.pairs()
+    return scan_selibr_lines(links, processes)
 
-def add_selibr_from_viaf(viaf_file, upload):
+
+def group_by_item(grouped):
+    """Turn a value → items map into an item → values map."""
+    items = {}
+    for value, value_items in grouped.items():
+        for item in value_items:
+            items.setdefault(item, set()).add(value)
+    return items
+
+
+def classify_link(viaf, selibr, wikidata, dump):
+    """
+    Decide what to do about a single VIAF ↔ SELIBR link.
+
+    Returns a crosswalk row, or None when there is
+    nothing to do (already on Wikidata, or no item).
+    """
+    items = (wikidata["viaf"].get(viaf, set()) |
+             wikidata["selibr"].get(selibr, set()))
+    if not items:
+        return None
+    if len(items) > 1:
+        return ["duplicate", ",".join(sorted(items)), "", "",
+                "VIAF {} and SELIBR {} are on different items".format(
+                    viaf, selibr)]
+    item = items.pop()
+    has_viaf = wikidata["item_viaf"].get(item, set())
+    has_selibr = wikidata["item_selibr"].get(item, set())
+    if viaf in has_viaf and selibr in has_selibr:
+        return None
+    if viaf in has_viaf:
+        if has_selibr:
+            return ["conflict", item, PROPERTIES["selibr"], selibr,
+                    "item already has SELIBR {}".format(
+                        ",".join(sorted(has_selibr)))]
+        if len(dump["viaf"][viaf]) > 1:
+            return ["conflict", item, PROPERTIES["selibr"], selibr,
+                    "VIAF {} has several SELIBR".format(viaf)]
+        return ["add_selibr", item, PROPERTIES["selibr"], selibr, ""]
+    if has_viaf:
+        return ["conflict", item, PROPERTIES["viaf"], viaf,
+                "item already has VIAF {}".format(
+                    ",".join(sorted(has_viaf)))]
+    if len(has_selibr) > 1 or len(dump["selibr"][selibr]) > 1:
+        return ["conflict", item, PROPERTIES["viaf"], viaf,
+                "SELIBR {} is ambiguous".format(selibr)]
+    return ["add_viaf", item, PROPERTIES["viaf"], viaf, ""]
+
+
+def add_claim(tool, item, claim, edit_summary):
+    """
+    Add a claim to an item, unless the journal says it's done.
+
+    Successful edits are recorded in the journal.
+    """
+    journal = upload_journal.get_journal()
+    if journal.done(claim["value"], claim, item):
+        print("{} already done according to journal.".format(item))
+        return
+    utils.wd_add_unique_claim(item, claim, edit_summary)
+    journal.record(tool, claim["value"], item, claim)
+
+
+def flag_several_values(rows):
+    """
+    Turn additions that would give an item several values into conflicts.
+
+    An item with two VIAFs linked to different SELIBRs
+    would otherwise get one add_selibr row per VIAF.
+    """
+    values = {}
+    for row in rows:
+        if row[0] in ("add_viaf", "add_selibr"):
+            values.setdefault((row[1], row[2]), set()).add(row[3])
+    flagged = set()
+    for row in rows:
+        several = values.get((row[1], row[2]), set())
+        if row[0] in ("add_viaf", "add_selibr") and len(several) > 1:
+            row = ("conflict", row[1], row[2], row[3],
+                   "item would get several values: {}".format(
+                       ",".join(sorted(several))))
+        flagged.add(row)
+    return flagged
+
+
+def build_crosswalk(links, table, processes=1):
+    """
+    Write a table of proposed edits from a single pass over the links.
+
+    All humans with VIAF and all humans with SELIBR are
+    fetched from Wikidata in bulk (get_humans_by_value), and
+    every link of the dump touching any of them is classified
+    as add_viaf, add_selibr, conflict or duplicate (one
+    person, several items). The table can then be uploaded with
+    the upload_crosswalk action.
+    """
+    wikidata = {"viaf": get_humans_by_value(PROPERTIES["viaf"]),
+                "selibr": get_humans_by_value(PROPERTIES["selibr"])}
+    wikidata["item_viaf"] = group_by_item(wikidata["viaf"])
+    wikidata["item_selibr"] = group_by_item(wikidata["selibr"])
+    dump = {"viaf": {}, "selibr": {}}
+    for viaf, selibr in iter_links(links, processes):
+        if viaf in wikidata["viaf"] or selibr in wikidata["selibr"]:
+            dump["viaf"].setdefault(viaf, set()).add(selibr)
+            dump["selibr"].setdefault(selibr, set()).add(viaf)
+    rows = set()
+    for viaf, selibrs in dump["viaf"].items():
+        for selibr in selibrs:
+            row = classify_link(viaf, selibr, wikidata, dump)
+            if row:
+                rows.add(tuple(row))
+    rows = flag_several_values(rows)
+    with open(table, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(CROSSWALK_COLUMNS)
+        writer.writerows(sorted(rows))
+    counts = {}
+    for row in rows:
+        counts[row[0]] = counts.get(row[0], 0) + 1
+    print("Saved crosswalk to {}: {}.".format(
+        table, ", ".join("{} {}".format(v, k)
+                         for k, v in sorted(counts.items()))))
+
+
+def upload_crosswalk(table, upload):
+    """Make the add_viaf and add_selibr edits of a crosswalk table."""
+    summaries = {
+        "add_viaf": make_editgroups_summary("Adding VIAF based on SELIBR"),
+        "add_selibr": make_editgroups_summary("Adding SELIBR based on VIAF")}
+    with open(table, newline="") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            if row["action"] not in summaries:
+                continue
+            print("{} → {}".format(row["item"], row["value"]))
+            if upload:
+                add_claim("viaf.py", row["item"],
+                          {"prop": row["property"], "value": row["value"]},
+                          summaries[row["action"]])
+
+
+def split_into_ranges(viaf_file, parts):
+    """
+    Split a file into byte ranges that start and end at line breaks.
+
+    Returns a list of (start, end) offsets.
+    """
+    size = os.path.getsize(viaf_file)
+    if size == 0:
+        return []
+    ranges = []
+    with open(viaf_file, "rb") as myfile:
+        start = 0
+        for i in range(1, parts):
+            myfile.seek(max(size * i // parts, start))
+            myfile.readline()
+            end = myfile.tell()
+            if end > start:
+                ranges.append((start, end))
+                start = end
+        if start < size:
+            ranges.append((start, size))
+    return ranges
+
+
+def iter_range(dump, start, end):
+    """
+    Yield (VIAF, SELIBR) pairs from a byte range of a mapped dump.
+
+    Only the lines containing the SELIBR marker are
+    decoded and split, the rest are skipped at bytes level.
+    """
+    position = dump.find(SELIBR_MARKER, start, end)
+    while position != -1:
+        line_start = dump.rfind(b"\n", start, position) + 1
+        if line_start == 0:
+            line_start = start
+        line_end = dump.find(b"\n", position, end)
+        if line_end == -1:
+            line_end = end
+        line = dump[line_start:line_end].decode("utf-8").rstrip("\r")
+        cleanline = is_selibr_line(line)
+        if cleanline:
+            yield cleanline
+        position = dump.find(SELIBR_MARKER, line_end, end)
+
+
+def scan_range(job):
+    """Collect the (VIAF, SELIBR) pairs of one byte range of a dump."""
+    viaf_file, start, end = job
+    with open(viaf_file, "rb") as myfile:
+        with mmap.mmap(myfile.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+            return list(iter_range(dump, start, end))
+
+
+def scan_selibr_lines(viaf_file, processes=1):
+    """
+    Yield (VIAF, SELIBR) pairs from a VIAF links dump.
+
+    The dump is memory-mapped. With more than one process,
+    it's split into line-aligned byte ranges which are
+    scanned in parallel; the pairs are still yielded in
+    the order of the file.
+
+    A gzip/bz2/xz compressed dump (as published by VIAF)
+    is instead decompressed on the fly, in one process.
+    """
+    opener = COMPRESSED.get(os.path.splitext(viaf_file)[1])
+    if opener:
+        with opener(viaf_file, "rb") as dump:
+            for line in dump:
+                if SELIBR_MARKER not in line:
+                    continue
+                cleanline = is_selibr_line(
+                    line.decode("utf-8").rstrip("\r\n"))
+                if cleanline:
+                    yield cleanline
+        return
+    if os.path.getsize(viaf_file) == 0:
+        return
+    if processes > 1:
+        jobs = [(viaf_file, start, end) for start, end in
+                split_into_ranges(viaf_file, processes * 4)]
+        with Pool(processes) as pool:
+            for pairs in pool.imap(scan_range, jobs):
+                for pair in pairs:
+                    yield pair
+        return
+    with open(viaf_file, "rb") as myfile:
+        with mmap.mmap(myfile.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+            for pair in iter_range(dump, 0, len(dump)):
+                yield pair
+
+
+def add_selibr_from_viaf(links, upload, processes=1):
     """
     1. identify VIAF posts that have a SELIBR
     2. check if therethere is a Wikidata item with this VIAF
     3. but it does not have selibr
     4. Add SELIBR to those items.
+
+    Steps 2 and 3 are answered for all items at once by
+    get_humans_with_viaf_no_selibr.rq, and the result is
+    joined with the links locally, so Wikidata is only
+    contacted again for the edits.
+
+    Like in the crosswalk, a VIAF with several SELIBR is
+    skipped, and so is an item whose VIAFs lead to more
+    than one SELIBR, so that no item gets several P906.
     """
     edit_summary = make_editgroups_summary("Adding SELIBR based on VIAF")
-    with open(viaf_file) as myfile:
-        for line in myfile:
-            cleanline = is_selibr_line(line)
-            if cleanline:
-                viaf = cleanline[0]
-                selibr = cleanline[1]
-                onwikidata = utils.run_query("get_item_with_property_value.rq",
-                (PROPERTIES["viaf"], viaf))
-                if not onwikidata:
-                    continue
-                q = onwikidata[0]["item"]
-                if utils.is_human(q):
-                    selibr_value = utils.get_claim(q, PROPERTIES["selibr"])
-                    if not selibr_value:
-                        print(q)
-                        if upload:
-                            utils.wd_add_unique_claim(q,
-                                                      {"prop":    PROPERTIES["selibr"],
-                                                       "value": selibr}, edit_summary)
-
+    humans_with_viaf_no_selibr = {}
+    for x in get_humans_with_viaf_no_selibr():
+        humans_with_viaf_no_selibr.setdefault(x["viaf"], x["item"])
+    if isinstance(links, LinksIndex):
+        matches = ((viaf, selibr)
+                   for viaf in humans_with_viaf_no_selibr
+                   for selibr in links.selibr_for_viaf(viaf))
+    else:
+        matches = ((viaf, selibr)
+                   for viaf, selibr in scan_selibr_lines(links, processes)
+                   if viaf in humans_with_viaf_no_selibr)
+    selibrs = {}
+    for viaf, selibr in matches:
+        selibrs.setdefault(viaf, set()).add(selibr)
+    item_selibrs = {}
+    for viaf, viaf_selibrs in selibrs.items():
+        if len(viaf_selibrs) > 1:
+            print("Skipping VIAF {}: it has several SELIBR ({}).".format(
+                viaf, ", ".join(sorted(viaf_selibrs))))
+            continue
+        q = humans_with_viaf_no_selibr[viaf]
+        item_selibrs.setdefault(q, set()).update(viaf_selibrs)
+    for q, q_selibrs in item_selibrs.items():
+        if len(q_selibrs) > 1:
+            print("Skipping {}: its VIAFs have different SELIBR "
+                  "({}).".format(q, ", ".join(sorted(q_selibrs))))
+            continue
+        selibr = q_selibrs.pop()
+        print("{} → {}".format(q, selibr))
+        if upload:
+            add_claim("viaf.py", q,
+                      {"prop": PROPERTIES["selibr"], "value": selibr},
+                      edit_summary)
 
 
 def is_selibr_line(viaf_file_line):
@@ -72,31 +428,48 @@ def is_selibr_line(viaf_file_line):
             return [cleanline[0].split("/")[-1], selibr]
 
 
-def add_viaf_from_selibr(viaf_file, upload):
+def add_viaf_from_selibr(links, upload, processes=1):
+    """
+    Add VIAF to humans that have a SELIBR but no VIAF.
+
+    The Wikidata query result is joined with the links
+    on SELIBR: through lookups in the index if there is one,
+    otherwise by scanning the dump once.
+    """
     edit_summary = make_editgroups_summary("Adding VIAF based on SELIBR")
-    humans_with_selibr_no_viaf = get_humans_with_selibr_no_viaf()
-    with open(viaf_file) as myfile:
-        for line in myfile:
-            cleanline = is_selibr_line(line)
-            if cleanline:
-                human_on_wikidata = [
-                    x for x in humans_with_selibr_no_viaf if x["selibr"] == cleanline[1]]
-                if human_on_wikidata:
-                    item_to_add_viaf_to = human_on_wikidata[0]["item"]
-                    viaf = cleanline[0]
-                    print("{} → {}".format(item_to_add_viaf_to, viaf))
-                    if upload:
-                        utils.wd_add_unique_claim(item_to_add_viaf_to,
-                                                  {"prop": PROPERTIES["viaf"],
-                                                   "value": viaf},
-                                                  edit_summary)
+    humans_with_selibr_no_viaf = {}
+    for x in get_humans_with_selibr_no_viaf():
+        humans_with_selibr_no_viaf.setdefault(x["selibr"], x["item"])
+    if isinstance(links, LinksIndex):
+        matches = ((viaf, selibr)
+                   for selibr in humans_with_selibr_no_viaf
+                   for viaf in links.viaf_for_selibr(selibr))
+    else:
+        matches = ((viaf, selibr)
+                   for viaf, selibr in scan_selibr_lines(links, processes)
+                   if selibr in humans_with_selibr_no_viaf)
+    for viaf, selibr in matches:
+        item_to_add_viaf_to = humans_with_selibr_no_viaf[selibr]
+        print("{} → {}".format(item_to_add_viaf_to, viaf))
+        if upload:
+            add_claim("viaf.py", item_to_add_viaf_to,
+                      {"prop": PROPERTIES["viaf"], "value": viaf},
+                      edit_summary)
 
 
 if __name__ == "__main__":
     PARSER = argparse.ArgumentParser()
-    PARSER.add_argument("--path", required=True)
+    PARSER.add_argument("--path")
+    PARSER.add_argument("--index")
     PARSER.add_argument("--action", required=True,
-                        choices=['add_viaf_from_selibr', 'add_selibr_from_viaf'])
+                        choices=['index', 'add_viaf_from_selibr',
+                                 'add_selibr_from_viaf', 'crosswalk',
+                                 'upload_crosswalk'])
     PARSER.add_argument("--upload", action='store_true')
+    PARSER.add_argument("--processes", type=int, default=1)
+    PARSER.add_argument("--table", default=CROSSWALK_FILE)
     ARGS = PARSER.parse_args()
+    if (not ARGS.path and ARGS.action != "upload_crosswalk" and
+            not (ARGS.index and ARGS.action != "index")):
+        PARSER.error("--path is required, unless an --index is used")
     main(ARGS)
@@ -7,14 +7,54 @@ http://librishelp.libris.kb.se/help/search_codes_swe.jsp
 
 Script follows pagination in the result
 and saves the final output to a json file.
+With --workers, the remaining pages are fetched
+concurrently once the first page has told
+how many records there are.
+
+With --jsonl, each page is appended to a JSON Lines
+file (gzipped with --gzip) as soon as it arrives,
+and the progress is saved next to it so that
+an interrupted harvest can continue with --resume.
+
+With --shard, the query is split into sub-queries by
+publication year (år:), narrowing the year ranges
+until each sub-query has at most the given number of
+records. The sub-queries are harvested in parallel
+and the merged result is deduplicated.
 """
 import argparse
+import gzip
 import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
-BASEURL = "http://libris.kb.se/xsearch?query={}&format=json&n=200&start={}"
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "shared"))
+import thread_pool  # noqa: E402
+
+BASEURL = "http://libris.kb.se/xsearch?query={}&format=json&n={}&start={}"
+PAGE_SIZE = 200
+WORKERS = 1
+
+ESCAPE = re.compile(r'\\(["\\/bfnrtu]?)')
 
 SAVEFILE = "xsearch.json"
+SAVEFILE_JSONL = "xsearch.jsonl"
+PROGRESS_SUFFIX = ".progress"
+FIRST_YEAR = 1400
+
+
+def escape_backslash(match):
+    """Keep a valid escape sequence, double a lone backslash."""
+    if match.group(1):
+        return match.group(0)
+    return '\\\\'
 
 
 def permissive_json_loads(text):
@@ -28,9 +68,19 @@ def permissive_json_loads(text):
     json parsing. This escapes them
     while reading the text chunk.
 
+    All the lone backslashes are escaped in a single
+    pass over the text before parsing, instead of
+    re-parsing the text once for every one of them.
+    The rarer unescaped quotes are still fixed
+    one at a time as the parser finds them.
+
     @param text: text to parse as json
     @type text: string
     """
+    try:
+        return json.loads(text)
+    except ValueError:
+        text = ESCAPE.sub(escape_backslash, text)
     while True:
         try:
             data = json.loads(text)
@@ -73,40 +123,368 @@ def json_to_file(filename, content):
     print("Saved {} objects to {}".format(len(content), filename))
 
 
-def harvest_query(query):
+def get_page(query, start):
+    """
+    Retrieve a single page of results.
+
+    @param query: Libris xsearch query
+    @type query: string
+    @param start: number of the first record on the page (from 1)
+    @type start: int
+    """
+    return get_from_url(BASEURL.format(query, PAGE_SIZE, start))
+
+
+def get_pages(query, starts, workers):
+    """
+    Retrieve several pages of results, in order.
+
+    With more than one worker the pages are downloaded
+    concurrently, but only a limited number of them
+    is kept in memory at any time.
+
+    @param query: Libris xsearch query
+    @type query: string
+    @param starts: numbers of the first record on each page
+    @type starts: iterable
+    @param workers: number of pages to download at the same time
+    @type workers: int
+    @return: pairs of start number and page content
+    """
+    if workers <= 1:
+        for start in starts:
+            yield start, get_page(query, start)
+        return
+    for start, future in thread_pool.ordered_map(
+            lambda start: get_page(query, start), starts,
+            workers, workers * 2):
+        yield start, future.result()
+
+
+def check_page(page, start, total_hits):
+    """
+    Warn if a page doesn't contain the expected number of records.
+
+    @param page: list of records on the page
+    @type page: list
+    @param start: number of the first record on the page (from 1)
+    @type start: int
+    @param total_hits: number of records in the whole result
+    @type total_hits: int
+    """
+    expected = min(PAGE_SIZE, total_hits - start + 1)
+    if len(page) != expected:
+        print("WARNING: Page starting at {} has {} objects, "
+              "expected {}.".format(start, len(page), expected))
+
+
+def check_harvest(harvest, total_hits):
+    """
+    Warn about duplicated or missing records in a harvest.
+
+    Records are identified by their "identifier" field.
+
+    @param harvest: all harvested records
+    @type harvest: list
+    @param total_hits: number of records reported by the API
+    @type total_hits: int
+    """
+    counts = Counter(x.get("identifier") for x in harvest)
+    duplicates = sum(n - 1 for n in counts.values() if n > 1)
+    unique = len(counts)
+    if duplicates:
+        print("WARNING: {} duplicated objects in harvest.".format(duplicates))
+    if unique < total_hits:
+        print("WARNING: {} objects missing from harvest.".format(
+            total_hits - unique))
+
+
+def harvest_query(query, workers=WORKERS):
     """
     Harvest results of API call.
 
+    The first page gives the total number of records,
+    so the offsets of all the remaining pages are known.
+    With more than one worker they are downloaded
+    concurrently and put back together in order.
+
     @param query: Libris xsearch query
     @type query: string
+    @param workers: number of pages to download at the same time
+    @type workers: int
     @return API call result as JSON object
     """
     harvest = []
-    url = BASEURL.format(query, "1")
-    content = get_from_url(url)
+    content = get_page(query, 1)
     total_hits = content["xsearch"]["records"]
     harvest.extend(content["xsearch"]["list"])
     print("Running query: {}.".format(query))
     print("{} objects to harvest.".format(total_hits))
     print("Harvested: {} objects.".format(len(harvest)))
-    while len(harvest) < total_hits:
-        to_record = int(content["xsearch"]["to"])
-        from_record = to_record + 1
-        url = "=".join(url.split("=")[:-1]) + "={}".format(from_record)
-        content = get_from_url(url)
-        harvest.extend(content["xsearch"]["list"])
-        print("Harvested: {} objects.".format(len(harvest)))
+    if workers > 1:
+        first_start = int(content["xsearch"]["to"]) + 1
+        starts = range(first_start, total_hits + 1, PAGE_SIZE)
+        for start, page in get_pages(query, starts, workers):
+            records = page["xsearch"]["list"]
+            check_page(records, start, total_hits)
+            harvest.extend(records)
+            print("Harvested: {} objects.".format(len(harvest)))
+    else:
+        while len(harvest) < total_hits:
+            from_record = int(content["xsearch"]["to"]) + 1
+            content = get_page(query, from_record)
+            harvest.extend(content["xsearch"]["list"])
+            print("Harvested: {} objects.".format(len(harvest)))
+    check_harvest(harvest, total_hits)
     return harvest
 
 
+def count_records(query):
+    """
+    Get the number of records matching a query.
+
+    @param query: Libris xsearch query
+    @type query: string
+    """
+    url = BASEURL.format(query, 1, 1)
+    return get_from_url(url)["xsearch"]["records"]
+
+
+def year_query(query, first, last):
+    """
+    Restrict a query to a range of publication years.
+
+    @param query: Libris xsearch query
+    @type query: string
+    @param first: first year of the range
+    @type first: int
+    @param last: last year of the range
+    @type last: int
+    """
+    if first == last:
+        return "({}) AND år:{}".format(query, first)
+    return "({}) AND år:>{} AND år:<{}".format(query, first - 1, last + 1)
+
+
+def make_shards(query, first, last, max_size):
+    """
+    Split a query into sub-queries by publication year.
+
+    A year range is halved until the sub-query covering
+    it has at most max_size records; a single year is
+    never split further. Empty ranges are left out.
+
+    @param query: Libris xsearch query
+    @type query: string
+    @param first: first year to cover
+    @type first: int
+    @param last: last year to cover
+    @type last: int
+    @param max_size: target maximum number of records per shard
+    @type max_size: int
+    @return: pairs of sub-query and number of records
+    """
+    shard = year_query(query, first, last)
+    size = count_records(shard)
+    if size == 0:
+        return []
+    if size <= max_size or first == last:
+        return [(shard, size)]
+    middle = (first + last) // 2
+    return (make_shards(query, first, middle, max_size) +
+            make_shards(query, middle + 1, last, max_size))
+
+
+def harvest_sharded(query, max_size, workers=WORKERS,
+                    first=FIRST_YEAR, last=None):
+    """
+    Harvest results of a large query as parallel sub-queries.
+
+    Records without a publication year in the given range
+    are not covered by any shard; the number of them is
+    reported. Records found by more than one shard are
+    only kept once.
+
+    @param query: Libris xsearch query
+    @type query: string
+    @param max_size: target maximum number of records per shard
+    @type max_size: int
+    @param workers: number of shards to harvest at the same time
+    @type workers: int
+    @param first: first publication year to cover
+    @type first: int
+    @param last: last publication year to cover, default next year
+    @type last: int
+    """
+    if last is None:
+        last = time.localtime().tm_year + 1
+    total_hits = count_records(query)
+    print("Running query: {}.".format(query))
+    print("{} objects to harvest.".format(total_hits))
+    shards = make_shards(query, first, last, max_size)
+    covered = sum(size for shard, size in shards)
+    print("Split into {} shards covering {} objects.".format(
+        len(shards), covered))
+    if covered < total_hits:
+        print("WARNING: {} objects have no publication year in {}-{} "
+              "and will not be harvested.".format(
+                  total_hits - covered, first, last))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = executor.map(lambda shard: harvest_query(shard[0]), shards)
+        harvest = []
+        seen = set()
+        for records in results:
+            for record in records:
+                identifier = record.get("identifier")
+                if identifier in seen:
+                    continue
+                seen.add(identifier)
+                harvest.append(record)
+    print("Harvested {} unique objects.".format(len(harvest)))
+    return harvest
+
+
+def load_progress(filename):
+    """
+    Load the progress of a streamed harvest.
+
+    @param filename: file the harvest is saved to
+    @type filename: string
+    """
+    try:
+        with open(filename + PROGRESS_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_progress(filename, progress):
+    """
+    Save the progress of a streamed harvest.
+
+    The file is replaced atomically, so it always
+    describes a complete state.
+
+    @param filename: file the harvest is saved to
+    @type filename: string
+    @param progress: query, next start number, number of
+                     records, harvested count and file size
+    @type progress: dictionary
+    """
+    tmp = filename + PROGRESS_SUFFIX + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(progress, f, sort_keys=True)
+    os.replace(tmp, filename + PROGRESS_SUFFIX)
+
+
+def append_page(filename, records, compress):
+    """
+    Append the records of a page to a JSON Lines file.
+
+    Each page is written (and closed) separately, so with
+    gzip the file is a series of complete gzip members.
+
+    @param filename: file to save to
+    @type filename: string
+    @param records: records to save, one per line
+    @type records: list
+    @param compress: whether to gzip the output
+    @type compress: bool
+    @return: size of the file after writing
+    """
+    lines = "".join(json.dumps(x, sort_keys=True, ensure_ascii=False) + "\n"
+                    for x in records).encode("utf-8")
+    if compress:
+        with open(filename, 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                gz.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+    with open(filename, 'ab') as f:
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def harvest_to_file(query, filename, compress=False, resume=False,
+                    workers=WORKERS):
+    """
+    Harvest results of API call straight to a JSON Lines file.
+
+    Only one page at a time (or a few, with workers)
+    is kept in memory. After each page, the next start
+    number is saved in a small progress file, and with
+    resume the harvest continues from there.
+
+    @param query: Libris xsearch query
+    @type query: string
+    @param filename: file to save to
+    @type filename: string
+    @param compress: whether to gzip the output
+    @type compress: bool
+    @param resume: continue an interrupted harvest of the same query
+    @type resume: bool
+    @param workers: number of pages to download at the same time
+    @type workers: int
+    """
+    print("Running query: {}.".format(query))
+    progress = load_progress(filename) if resume else None
+    if progress and progress["query"] != query:
+        raise ValueError("{} contains a harvest of another query: {}".format(
+            filename, progress["query"]))
+    if progress:
+        with open(filename, 'r+b') as f:
+            f.truncate(progress["size"])
+        print("Resuming from object {}.".format(progress["next_start"]))
+    else:
+        open(filename, 'wb').close()
+        content = get_page(query, 1)
+        records = content["xsearch"]["list"]
+        progress = {"query": query,
+                    "records": content["xsearch"]["records"],
+                    "next_start": int(content["xsearch"]["to"]) + 1,
+                    "harvested": len(records)}
+        progress["size"] = append_page(filename, records, compress)
+        save_progress(filename, progress)
+    total_hits = progress["records"]
+    print("{} objects to harvest.".format(total_hits))
+    print("Harvested: {} objects.".format(progress["harvested"]))
+    starts = range(progress["next_start"], total_hits + 1, PAGE_SIZE)
+    for start, page in get_pages(query, starts, workers):
+        records = page["xsearch"]["list"]
+        check_page(records, start, total_hits)
+        progress["size"] = append_page(filename, records, compress)
+        progress["harvested"] += len(records)
+        progress["next_start"] = start + PAGE_SIZE
+        save_progress(filename, progress)
+        print("Harvested: {} objects.".format(progress["harvested"]))
+    print("Saved {} objects to {}".format(progress["harvested"], filename))
+
+
 def main(args):
     """Read arguments and run API call."""
+    if args["jsonl"]:
+        if args["file"]:
+            filename = "{}.jsonl".format(args["file"])
+        else:
+            filename = SAVEFILE_JSONL
+        if args["gzip"]:
+            filename += ".gz"
+        harvest_to_file(args["query"], filename, args["gzip"],
+                        args["resume"], args["workers"])
+        return
     if args["file"]:
         filename = "{}.json".format(args["file"])
     else:
         filename = SAVEFILE
-    if args["query"]:
-        harvest = harvest_query(args["query"])
+    if args["query"] and args["shard"]:
+        harvest = harvest_sharded(args["query"], args["shard"],
+                                  args["workers"])
+        json_to_file(filename, harvest)
+    elif args["query"]:
+        harvest = harvest_query(args["query"], args["workers"])
         json_to_file(filename, harvest)
 
 
@@ -114,5 +492,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--query", required=True)
     parser.add_argument("--file")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="number of pages to download concurrently")
+    parser.add_argument("--jsonl", action="store_true",
+                        help="append each page to a JSON Lines file \
+                        as it arrives")
+    parser.add_argument("--gzip", action="store_true",
+                        help="gzip the --jsonl output")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted --jsonl harvest")
+    parser.add_argument("--shard", type=int,
+                        help="split the query by publication year into \
+                        sub-queries of at most this many objects")
     args = parser.parse_args()
+    if (args.gzip or args.resume) and not args.jsonl:
+        parser.error("--gzip and --resume can only be used with --jsonl")
+    if args.shard and args.jsonl:
+        parser.error("--shard cannot be used with --jsonl")
     main(vars(args))
@@ -276,16 +276,12 @@ class Edition(WikidataItem):
                         found_languages.append(rl["@id"].split("/")[-1])
             if found_languages:
                 for lang in found_languages:
-                    lang_q = [x.get("q")
-                              for x in
-                              lang_map if x["name"] == lang]
+                    lang_q = lang_map.get(lang, "q")
                     if lang_q:
                         self.add_statement("language",
                                            lang_q[0],
                                            ref=self.source)
-            self.lang_wikidata = [x.get("wikidata")
-                                  for x in
-                                  lang_map if x["name"] == found_languages[0]]
+            self.lang_wikidata = lang_map.get(found_languages[0], "wikidata")
         elif self.mode == "local":
             for el in self.raw_data:
                 found = el.get("language")
@@ -296,17 +292,13 @@ class Edition(WikidataItem):
                     if lang.get("@id"):
                         canonical = lang["@id"].split("/")[-1]
                         languages.append(canonical)
-                        lang_q = [x.get("q")
-                                  for x in
-                                  lang_map if x["name"] == canonical]
+                        lang_q = lang_map.get(canonical, "q")
                         if lang_q:
                             self.add_statement(
                                 "language", lang_q[0], ref=self.source)
 
             if languages:
-                self.lang_wikidata = [x.get("wikidata")
-                                      for x in lang_map if
-                                      x["name"] == languages[0]]
+                self.lang_wikidata = lang_map.get(languages[0], "wikidata")
         if self.lang_wikidata:
             self.lang_wikidata = self.lang_wikidata[0]
 
@@ -347,9 +339,7 @@ class Edition(WikidataItem):
                 if raw_agent.get("@type").lower() == "agent":
                     agent_labels = raw_agent.get("label")
                     for label in agent_labels:
-                        wd_match = [x.get("wikidata")
-                                    for x in
-                                    publishers if x["name"] == label]
+                        wd_match = publishers.get(label, "wikidata")
                         if wd_match:
                             self.add_statement(
                                 "publisher", wd_match,
@@ -373,9 +363,7 @@ class Edition(WikidataItem):
                             for label in place_labels:
                                 label = label.replace("[", "")
                                 label = label.replace("]", "")
-                                wd_match = [x.get("wikidata")
-                                            for x in
-                                            place_map if x["name"] == label]
+                                wd_match = place_map.get(label, "wikidata")
                                 if wd_match:
                                     self.add_statement(
                                         "publication_place", wd_match,
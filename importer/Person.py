@@ -31,7 +31,7 @@ class Person(WikidataItem):
         """
         Set first name.
 
-        Use the cache if possible, otherwise query Wikidata.
+        Use the cache if possible, otherwise the name index.
         """
         raw_first_name = self.get_first_name()
         if (not raw_first_name or
@@ -63,7 +63,7 @@ class Person(WikidataItem):
         """
         Set surname.
 
-        Use the cache if possible, otherwise query Wikidata.
+        Use the cache if possible, otherwise the name index.
         """
         raw_surname = self.get_last_name()
         if (not raw_surname or
@@ -87,9 +87,8 @@ class Person(WikidataItem):
 
     def nationality_in_latin_country(self):
         """Check if nationality is in a country with Latin script."""
-        latin_countries = [x["country"] for
-                           x in self.data_files["latin_countries"]]
-        return any(x in self.nationality for x in latin_countries)
+        latin_countries = self.data_files["latin_countries"]
+        return any(x in latin_countries for x in self.nationality)
 
     def set_labels(self):
         """
@@ -181,9 +180,7 @@ class Person(WikidataItem):
                 if p.get("label"):
                     for l in p["label"]:
                         prof_to_match = l.lower()
-                        prof_q = [x.get("q")
-                                  for x in
-                                  prof_map if x["name"] == prof_to_match]
+                        prof_q = prof_map.get(prof_to_match, "q")
                         if prof_q and len(prof_q[0]) > 0:
                             self.add_statement(
                                 "profession", prof_q, ref=self.source)
@@ -275,9 +272,7 @@ class Person(WikidataItem):
         country_map = self.data_files["countries"]
         nationalities = self.get_nationalities()
         for nat in nationalities:
-            nat_q = [x.get("q")
-                     for x in
-                     country_map if x["name"] == nat]
+            nat_q = country_map.get(nat, "q")
             if nat_q and len(nat_q[0]) > 0:
                 self.nationality.append(nat_q[0])
                 self.add_statement("citizenship", nat_q, ref=self.source)
@@ -341,9 +336,7 @@ class Person(WikidataItem):
         #  That way we avoid editing WD items with multiple
         #  P906 (error either on WD or in Libris)
         elif selibr_match:
-            selibrs_on_this_q = [x for x in selibrs.keys()
-                                 if selibrs[x] == selibr_match]
-            if len(selibrs_on_this_q) == 1:
+            if selibr_match not in self.data_files["multiple_selibr"]:
                 self.associate_wd_item(selibr_match)
             else:
                 self.set_upload(False)
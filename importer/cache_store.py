@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Name caches kept in memory for a whole run.
+
+Each cache is stored as a json file (e.g. cache/surname.json)
+plus a log of the entries added since it was last written
+(cache/surname.log, one json [key, value] pair per line).
+New entries are only appended to the log, so adding one
+costs the same however big the cache is. Now and then, and
+when the run ends, the log is compacted: the full cache is
+written to a new json file, which replaces the old one, and
+the log is emptied. A line cut off by a crash is ignored
+the next time the cache is loaded.
+"""
+import json
+import os
+
+import importer_utils as utils
+
+COMPACT_EVERY = 1000
+
+
+class LoggedCache(dict):
+    """A dict that logs every changed entry to a store."""
+
+    def __init__(self, store, name, *args):
+        super().__init__(*args)
+        self.store = store
+        self.name = name
+
+    def __setitem__(self, key, value):
+        if key in self and self[key] == value:
+            return
+        super().__setitem__(key, value)
+        self.store.log(self.name, key, value)
+
+
+class CacheStore(object):
+    """A set of name caches with an append-only log on disk."""
+
+    def __init__(self, path, names):
+        """
+        Load caches from a directory.
+
+        :param path: cache directory
+        :param names: names of the caches, e.g. ["surname"]
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.caches = {}
+        self.logs = {}
+        self.logged = 0
+        for name in names:
+            self.caches[name] = LoggedCache(self, name, self.load(name))
+            self.logs[name] = open(self.log_path(name), "a",
+                                   encoding="utf-8")
+
+    def json_path(self, name):
+        return os.path.join(self.path, "{}.json".format(name))
+
+    def log_path(self, name):
+        return os.path.join(self.path, "{}.log".format(name))
+
+    def load(self, name):
+        """Load a cache from its json file and log."""
+        cache = {}
+        if os.path.exists(self.json_path(name)):
+            cache = utils.load_json(self.json_path(name)) or {}
+        if not os.path.exists(self.log_path(name)):
+            return cache
+        complete = 0
+        with open(self.log_path(name), "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                complete += len(line)
+                key, value = json.loads(line.decode("utf-8"))
+                cache[key] = value
+        if complete < os.path.getsize(self.log_path(name)):
+            with open(self.log_path(name), "r+b") as f:
+                f.truncate(complete)
+        return cache
+
+    def log(self, name, key, value):
+        """Append an entry to the log of a cache."""
+        log = self.logs[name]
+        log.write(json.dumps([key, value], ensure_ascii=False) + "\n")
+        log.flush()
+        self.logged += 1
+        if self.logged >= COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        """Write the full caches to json and empty the logs."""
+        for name, cache in self.caches.items():
+            tmp = self.json_path(name) + ".tmp"
+            utils.json_to_file(tmp, dict(cache), silent=True)
+            os.replace(tmp, self.json_path(name))
+            self.logs[name].truncate(0)
+        self.logged = 0
+
+    def close(self):
+        """Compact the caches and close the logs."""
+        self.compact()
+        for log in self.logs.values():
+            log.close()
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Compact, read-only identifier → QID index on disk.
+
+The maps of e.g. all Libris URIs or ISBNs on Wikidata take
+gigabytes as ordinary dicts. In an index file the
+identifiers are stored sorted, padded to the same width,
+and the QIDs as 32-bit integers, so that one entry takes
+a few dozen bytes. The file is memory-mapped, which means
+that it's not read into memory up front and that several
+processes using the same index share a single copy.
+
+Lookups work like on the dicts they replace:
+index.get("9789100000000") returns "Q123" or None.
+"""
+import mmap
+import os
+import struct
+
+MAGIC = b"IDIX"
+HEADER = struct.Struct("<4sIQ")
+QID = struct.Struct("<I")
+MAX_WIDTH = 64
+
+
+def qid_to_int(qid):
+    """Convert "Q123" to 123, or None if it's not a QID."""
+    if not qid or qid[0] not in "Qq" or not qid[1:].isdigit():
+        return None
+    number = int(qid[1:])
+    return number if number < 2 ** 32 else None
+
+
+class IdIndex(object):
+    """A sorted identifier → QID index, memory-mapped read-only."""
+
+    def __init__(self, path):
+        """
+        Open an index file.
+
+        @param path: index file, created with IdIndex.write
+        @type path: string
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            magic, self.width, self.count = HEADER.unpack(
+                f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("{} is not an index file.".format(path))
+            if self.count:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.mm = b""
+        self.keys_start = HEADER.size
+        self.qids_start = self.keys_start + self.width * self.count
+
+    @staticmethod
+    def write(path, mapping):
+        """
+        Save a dict of identifier → QID as an index file.
+
+        Entries whose value isn't a QID, or whose identifier
+        is longer than MAX_WIDTH bytes, are left out. The file
+        is written under a temporary name and moved into place.
+
+        @param path: index file to create
+        @type path: string
+        @param mapping: identifiers and QIDs
+        @type mapping: dictionary
+        @return: number of entries left out
+        """
+        entries = []
+        skipped = 0
+        for key, qid in mapping.items():
+            encoded = str(key).encode("utf-8")
+            number = qid_to_int(qid)
+            if number is None or len(encoded) > MAX_WIDTH:
+                skipped += 1
+                continue
+            entries.append((encoded, number))
+        entries.sort()
+        width = max([len(key) for key, _ in entries] or [0])
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, width, len(entries)))
+            f.write(b"".join(key.ljust(width, b"\0") for key, _ in entries))
+            f.write(b"".join(QID.pack(number) for _, number in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return skipped
+
+    def key_at(self, i):
+        """Get the padded identifier at position i."""
+        start = self.keys_start + i * self.width
+        return self.mm[start:start + self.width]
+
+    def qid_at(self, i):
+        """Get the QID at position i."""
+        start = self.qids_start + i * QID.size
+        return "Q{}".format(QID.unpack(self.mm[start:start + QID.size])[0])
+
+    def find(self, key):
+        """Get the position of an identifier, or None."""
+        if not isinstance(key, str):
+            return None
+        encoded = key.encode("utf-8")
+        if not encoded or len(encoded) > self.width:
+            return None
+        target = encoded.ljust(self.width, b"\0")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key_at(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.key_at(low) == target:
+            return low
+        return None
+
+    def get(self, key, default=None):
+        """Get the QID of an identifier, like dict.get."""
+        i = self.find(key)
+        return default if i is None else self.qid_at(i)
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i is None:
+            raise KeyError(key)
+        return self.qid_at(i)
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        """Iterate over the identifiers, in sorted order."""
+        for i in range(self.count):
+            yield self.key_at(i).rstrip(b"\0").decode("utf-8")
+
+    def values(self):
+        """Iterate over the QIDs, in the order of the identifiers."""
+        for i in range(self.count):
+            yield self.qid_at(i)
+
+    def items(self):
+        """Iterate over (identifier, QID) pairs."""
+        return zip(self.keys(), self.values())
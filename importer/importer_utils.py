@@ -1,14 +1,34 @@
 #!/usr/bin/python
 # -*- coding: utf-8  -*-
+import bz2
 import datetime
+import gzip
 import json
+import lzma
 import os
 import re
+import sys
+import tarfile
+import time
+import unicodedata
+import zipfile
 
 import pywikibot
 import pywikibot.data.sparql as sparql
 import wikidataStuff.helpers as helpers
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "shared"))
+import id_index  # noqa: E402
+import snapshot_cache  # noqa: E402
+import wdqs_pages  # noqa: E402
+
 site_cache = {}
+name_indexes = {}
+
+COMPRESSED = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+# given name and family name
+NAME_ITEMS = {"first": "Q202444", "last": "Q101352"}
 
 
 def lowercase_first(text):
@@ -37,9 +57,15 @@ def string_is_q_item(text):
         return False
 
 
+def open_compressed(filename):
+    """Open a text file, decompressing it on the fly if needed."""
+    opener = COMPRESSED.get(os.path.splitext(filename)[1], open)
+    return opener(filename, "rt", encoding="utf-8")
+
+
 def load_json(filename):
     try:
-        with open(filename) as f:
+        with open_compressed(filename) as f:
             try:
                 return json.load(f)
             except ValueError:
@@ -48,6 +74,55 @@ def load_json(filename):
         print("File {} does not exist.".format(filename))
 
 
+def decode_json(content, name):
+    """Decode json bytes from an archive member, or None if broken."""
+    try:
+        return json.loads(content.decode("utf-8"))
+    except ValueError:
+        print("Failed to decode file {}.".format(name))
+
+
+def iter_json_files(path):
+    """
+    Load json files one by one from a directory or an archive.
+
+    The path can be a directory of json files (each one
+    optionally gzip/bz2/xz compressed), a tar archive
+    (optionally compressed) or a zip archive of json files,
+    or a single, optionally compressed, json file.
+    Archives are read as streams, without unpacking
+    them to disk. Files that can't be decoded are skipped.
+
+    :param path: directory, archive or file to load
+    """
+    if os.path.isdir(path):
+        for fname in os.listdir(path):
+            data = load_json(os.path.join(path, fname))
+            if data is not None:
+                yield data
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith("/"):
+                    continue
+                data = decode_json(archive.read(info), info.filename)
+                if data is not None:
+                    yield data
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                content = archive.extractfile(member).read()
+                data = decode_json(content, member.name)
+                if data is not None:
+                    yield data
+    else:
+        data = load_json(path)
+        if data is not None:
+            yield data
+
+
 def create_site_instance(language, family):
     """Create an instance of a Wiki site (convenience function)."""
     site_key = (language, family)
@@ -99,6 +174,89 @@ def get_wd_items_using_prop(prop):
     The output is a dictionary of ID's and items
     that looks like this:
     {'4420': 'Q28936211', '2041': 'Q28933898'}
+
+    The result is kept in a local snapshot, see snapshot_cache.
+    """
+    return wdqs_pages.get_items_using_prop_cached(
+        prop, download_wd_items_using_prop)
+
+
+def get_wd_index_using_prop(prop, normalize=None):
+    """
+    Get WD items that already have some value of a unique ID.
+
+    Works like get_wd_items_using_prop, but returns a
+    memory-mapped IdIndex built from the snapshot, which
+    takes a fraction of the memory of a dict and is shared
+    between processes. The index is rebuilt when the
+    snapshot is refreshed.
+
+    :param normalize: function applied to every ID before
+                      it's indexed, returning None for IDs
+                      that should be left out
+    """
+    path, max_age = snapshot_cache.get_settings()
+    name = prop if normalize is None else "{}.{}".format(
+        prop, normalize.__name__)
+    if path is None:
+        items = get_wd_items_using_prop(prop)
+        if normalize is None:
+            return items
+        return normalize_keys(items, normalize)
+    filename = snapshot_cache.snapshot_path(path, name, ".idx")
+    snapshot = snapshot_cache.snapshot_path(path, prop)
+    try:
+        fresh = (os.stat(filename).st_mtime_ns ==
+                 os.stat(snapshot).st_mtime_ns and
+                 time.time() - os.path.getmtime(filename) < max_age)
+    except OSError:
+        fresh = False
+    if not fresh:
+        items = get_wd_items_using_prop(prop)
+        if normalize is not None:
+            items = normalize_keys(items, normalize)
+        skipped = id_index.IdIndex.write(filename, items)
+        if skipped:
+            print("LEFT {} INVALID ENTRIES OF {} OUT OF INDEX".format(
+                skipped, prop))
+        if os.path.exists(snapshot):
+            mtime = os.stat(snapshot).st_mtime_ns
+            os.utime(filename, ns=(mtime, mtime))
+    return id_index.IdIndex(filename)
+
+
+def get_items_with_multiple_values(items):
+    """
+    Get the items that have more than one value of a unique ID.
+
+    :param items: ID → item map, from get_wd_items_using_prop
+    :return: item → list of its IDs, for items with several IDs
+    """
+    values = {}
+    for value, item in items.items():
+        values.setdefault(item, []).append(value)
+    return {item: sorted(item_values)
+            for item, item_values in values.items()
+            if len(item_values) > 1}
+
+
+def normalize_keys(items, normalize):
+    """Apply a function to the keys of a dict, dropping None."""
+    normalized = {}
+    for k, v in items.items():
+        key = normalize(k)
+        if key is not None:
+            normalized[key] = v
+    return normalized
+
+
+def download_wd_items_using_prop(prop):
+    """
+    Query WDQS for WD items that have some value of a unique ID.
+
+    Gets them all in a single query. Properties used by
+    too many items for that are downloaded in pages by
+    wdqs_pages instead.
     """
     items = {}
     print("WILL NOW DOWNLOAD WD ITEMS THAT USE " + prop)
@@ -114,19 +272,77 @@ def get_wd_items_using_prop(prop):
     return items
 
 
+class MappingTable(object):
+    """
+    A mapping file indexed by name.
+
+    The mapping files are lists of objects with a "name"
+    and some values, e.g. {"name": "swe", "q": "Q9027"}.
+    Looking up a name returns the same values, in the same
+    order, as scanning the list for entries with that name.
+    """
+
+    def __init__(self, entries, key="name"):
+        self.entries = {}
+        for entry in entries:
+            self.entries.setdefault(
+                normalize_name(entry[key]), []).append(entry)
+
+    def get(self, name, field):
+        """
+        Get a field of all entries with a name.
+
+        :param name: name to look up, e.g. "swe"
+        :param field: field to get, e.g. "q"
+        :return: list of the values, empty if there are none
+        """
+        if not isinstance(name, str):
+            return []
+        return [entry.get(field) for entry in
+                self.entries.get(normalize_name(name), [])]
+
+
+def normalize_name(name):
+    """Normalize a name for lookup in the name index."""
+    return unicodedata.normalize("NFC", name).strip()
+
+
+def get_name_index(which):
+    """
+    Get a map of all names of a type to their WD items.
+
+    All items that are instances of (a subclass of) given
+    name or family name are downloaded once, and looked up
+    by their native label (P1705). Names shared by several
+    items are left out. The map is kept in a snapshot, see
+    snapshot_cache.
+
+    :param which: "first" or "last"
+    """
+    if which not in name_indexes:
+        pattern = ("?item wdt:P31/wdt:P279* wd:{}. "
+                   "?item wdt:P1705 ?value.").format(NAME_ITEMS[which])
+
+        def download():
+            print("WILL NOW DOWNLOAD ALL WD ITEMS OF {} NAMES".format(
+                which.upper()))
+            names = wdqs_pages.get_unique_values(pattern, normalize_name)
+            print("FOUND {} {} NAMES".format(len(names), which.upper()))
+            return names
+
+        name_indexes[which] = snapshot_cache.load(
+            "{}_names".format(which), download)
+    return name_indexes[which]
+
+
 def get_name(which, namevalue):
-    if which == "first":
-        name_item = "Q202444"
-    elif which == "last":
-        name_item = "Q101352"
-    query = "SELECT DISTINCT ?item WHERE {?item wdt:P31/wdt:P279* wd:" + \
-        name_item + ". ?item wdt:P1705 ?value. FILTER(str(?value) = '" + \
-        namevalue + "')}"
-    print("Querying WD for {} name {}.".format(which, namevalue))
-    sparql_query = sparql.SparqlQuery()
-    data = sparql_query.select(query)
-    if len(data) == 1:
-        return sanitize_wdqs_result(data[0]['item'])
+    """
+    Get the WD item of a first or last name.
+
+    :param which: "first" or "last"
+    :param namevalue: the name, e.g. "Selma"
+    """
+    return get_name_index(which).get(normalize_name(namevalue))
 
 
 def date_to_dict(datestring, dateformat):
@@ -14,12 +14,17 @@ to a single post, using either local or online data
 import argparse
 import json
 import os
+import sys
 import pywikibot
-import requests
 
-import importer_utils as utils
-from Person import Person
-from Uploader import Uploader
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "shared"))
+import cache_store  # noqa: E402
+import http_cache  # noqa: E402
+import importer_utils as utils  # noqa: E402
+import upload_journal  # noqa: E402
+from Person import Person  # noqa: E402
+from Uploader import Uploader  # noqa: E402
 
 EDIT_SUMMARY = "#WMSE #LibraryData_KB"
 MAPPINGS = "mappings"
@@ -32,6 +37,8 @@ def make_filenames(timestamp):
     filenames = {}
     utils.create_dir(REPORTING_DIR)
     filenames['reports'] = os.path.join(
+        REPORTING_DIR, "report_auth_{}.jsonl".format(timestamp))
+    filenames['reports_pretty'] = os.path.join(
         REPORTING_DIR, "report_auth_{}.json".format(timestamp))
 
     return filenames
@@ -46,9 +53,17 @@ def load_mapping_files():
     for title in local:
         f = os.path.join(MAPPINGS, '{}.json'.format(title))
         mappings[title] = utils.load_json(f)
+    for title in ["countries", "professions"]:
+        mappings[title] = utils.MappingTable(mappings[title])
+    mappings["latin_countries"] = frozenset(
+        x["country"] for x in mappings["latin_countries"])
     for title in remote:
         mappings[title] = utils.get_wd_items_using_prop(
             mappings["properties"][title])
+    mappings["multiple_selibr"] = utils.get_items_with_multiple_values(
+        mappings["selibr"])
+    print("{} items with more than one SELIBR will be skipped.".format(
+        len(mappings["multiple_selibr"])))
     print("Loaded local mappings: {}.".format(", ".join(local)))
     print("Loaded remote mappings: {}.".format(", ".join(remote)))
     return mappings
@@ -62,70 +77,99 @@ def is_person(auth_item):
 def get_from_uri(uri):
     """Load data from uri."""
     url = "https://libris.kb.se/{}/data.jsonld".format(uri)
-    return json.loads(requests.get(url).text)
+    return json.loads(http_cache.get_text(url))
 
 
-def list_available_files(path, limit=None, uri=None):
+def get_uri(data):
+    """Get the Libris URI of a json-ld post."""
+    return data["@graph"][0]["@id"].split("/")[-1]
+
+
+def load_available_files(path, limit=None, uri=None):
     """
-    Load a list of files in directory.
+    Load the json-ld files in a directory or archive, one by one.
+
+    The path can also be a (compressed) tar or zip
+    archive, which is read without unpacking it.
 
     :param limit: return the first x files."
+    :param uri: only return the file with this Libris URI
     """
-    files = []
-    for fname in os.listdir(path):
-        files.append(os.path.join(path, fname))
+    for i, data in enumerate(utils.iter_json_files(path)):
         if uri:
-            data = utils.load_json(os.path.join(path, fname))
-            file_uri = data["@graph"][0]["@id"].split("/")[-1]
-            if file_uri == uri:
+            if get_uri(data) == uri:
                 print("Ready to process file with URI {}.".format(uri))
-                return [os.path.join(path, fname)]
-    if limit:
-        files = files[:limit]
-    print("Ready to process {} files.".format(len(files)))
-    return files
-
-
-def load_caches(keys):
-    cache = {}
-    for k in keys:
-        fpath = os.path.join(CACHE, "{}.json".format(k))
-        if os.path.exists(fpath):
-            cache[k] = utils.load_json(fpath)
-        else:
-            cache[k] = {}
-    return cache
-
-
-def dump_caches(wditem_caches):
-    for cache in wditem_caches:
-        fname = os.path.join(CACHE, "{}.json".format(cache))
-        utils.json_to_file(fname, wditem_caches[cache])
+                yield data
+                return
+            continue
+        if limit and i >= limit:
+            return
+        yield data
 
 
 def main(arguments):
     """Get arguments and process data."""
-    libris_files = list_available_files(arguments.get("dir"),
+    libris_files = load_available_files(arguments.get("dir"),
                                         arguments.get("limit"),
                                         arguments.get("uri"))
     filenames = make_filenames(utils.get_current_timestamp())
 
     wikidata_site = utils.create_site_instance("wikidata", "wikidata")
     data_files = load_mapping_files()
-    existing_people = utils.get_wd_items_using_prop(
+    existing_people = utils.get_wd_index_using_prop(
         data_files["properties"]["libris_uri"])
-    problem_reports = []
+    journal = upload_journal.get_journal()
+    store = cache_store.CacheStore(CACHE, ["surname", "first_name"])
+    try:
+        with open(filenames['reports'], "a", encoding="utf-8") as reports:
+            saved = process_files(libris_files, arguments, wikidata_site,
+                                  data_files, existing_people, store.caches,
+                                  journal, reports)
+    finally:
+        store.close()
+    if not saved:
+        os.remove(filenames['reports'])
+        return
+    print("SAVED PROBLEM REPORTS TO {}".format(filenames['reports']))
+    if arguments.get("pretty_report"):
+        merge_reports(filenames['reports'], filenames['reports_pretty'])
+
+
+def save_report(reports, problem_report):
+    """Append a problem report as one line of json."""
+    reports.write(json.dumps(problem_report, sort_keys=True,
+                             ensure_ascii=False,
+                             default=utils.datetime_convert) + "\n")
+    reports.flush()
+
+
+def merge_reports(filename, pretty_filename):
+    """Save the problem reports of a run as a single json list."""
+    with open(filename, encoding="utf-8") as f:
+        problem_reports = [json.loads(line) for line in f if line.strip()]
+    utils.json_to_file(pretty_filename, problem_reports)
+
+
+def process_files(libris_files, arguments, wikidata_site, data_files,
+                  existing_people, cache, journal, reports):
+    """
+    Process the authority posts and upload them.
 
-    for fname in libris_files:
-        data = utils.load_json(fname)
-        cache = load_caches(["surname", "first_name"])
+    :param reports: open file to append problem reports to
+    :return: number of problem reports saved
+    """
+    saved = 0
+    for data in libris_files:
+        if (arguments.get("upload") == "live" and
+                journal.done(get_uri(data), data)):
+            print("{} is already uploaded.".format(get_uri(data)))
+            continue
         if is_person(data):
             person = Person(data,
                             wikidata_site,
                             data_files,
                             existing_people,
                             cache)
-            dump_caches(person.get_caches())
             problem_report = person.get_report()
             if arguments.get("upload"):
                 live = True if arguments["upload"] == "live" else False
@@ -140,15 +184,16 @@ def main(arguments):
                     problem_report["Q"] = uploader.wd_item_q
                 try:
                     uploader.upload()
+                    if live and uploader.data["upload"]:
+                        journal.record("process_auth", get_uri(data),
+                                       uploader.wd_item_q, data)
                 except pywikibot.data.api.APIError as e:
                     print(e)
 
             if problem_report:
-                problem_reports.append(problem_report)
-                utils.json_to_file(
-                    filenames['reports'], problem_reports, silent=True)
-    if problem_reports:
-        print("SAVED PROBLEM REPORTS TO {}".format(filenames['reports']))
+                save_report(reports, problem_report)
+                saved += 1
+    return saved
 
 
 if __name__ == "__main__":
@@ -156,6 +201,7 @@ if __name__ == "__main__":
     parser.add_argument("--dir", required=True)
     parser.add_argument("--uri")
     parser.add_argument("--upload", action='store')
+    parser.add_argument("--pretty_report", action='store_true')
     parser.add_argument("--limit",
                         nargs='?',
                         type=int,
@@ -3,14 +3,17 @@
 import argparse
 import json
 import os
+import sys
 import pywikibot
-import requests
 from stdnum import isbn as isbn_tool
-import importer_utils as utils
 
-
-from Edition import Edition
-from Uploader import Uploader
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "shared"))
+import http_cache  # noqa: E402
+import importer_utils as utils  # noqa: E402
+import upload_journal  # noqa: E402
+from Edition import Edition  # noqa: E402
+from Uploader import Uploader  # noqa: E402
 
 MAPPINGS = "mappings"
 EDIT_SUMMARY = "#WMSE #LibraryData_KB"
@@ -25,34 +28,36 @@ def get_libris_id(data):
             return sa["@id"].split("/")[-1]
 
 
-def list_available_files(path, limit=None, uri=None):
+def get_uri(data):
+    """Get the Libris URI of a json-ld post."""
+    return data["@graph"][0]["@id"].split("/")[-1]
+
+
+def load_available_files(path, limit=None, uri=None):
     """
-    Load a list of files in directory.
+    Load the json-ld files in a directory or archive, one by one.
+
+    The path can also be a (compressed) tar or zip
+    archive, which is read without unpacking it.
 
     :param limit: return the first x files."
+    :param uri: only return the file with this Libris URI
     """
-    files = []
-    for fname in os.listdir(path):
-        files.append(os.path.join(path, fname))
+    for i, data in enumerate(utils.iter_json_files(path)):
         if uri:
-            data = utils.load_json(os.path.join(path, fname))
-            file_uri = data["@graph"][0]["@id"].split("/")[-1]
-            if file_uri == uri:
+            if get_uri(data) == uri:
                 print("Ready to process file with URI {}.".format(uri))
-                return [os.path.join(path, fname)]
-    if limit:
-        files = files[:limit]
-    print("Ready to process {} files.".format(len(files)))
-    return files
+                yield data
+                return
+            continue
+        if limit and i >= limit:
+            return
+        yield data
 
 
-def normalize_isbn_map(data):
-    normalized = {}
-    for k, v in data.items():
-        if isbn_tool.is_valid(k):
-            compact_isbn = isbn_tool.compact(k)
-            normalized[compact_isbn] = v
-    return normalized
+def normalize_isbn(isbn):
+    if isbn_tool.is_valid(isbn):
+        return isbn_tool.compact(isbn)
 
 
 def load_mapping_files():
@@ -64,12 +69,15 @@ def load_mapping_files():
     for title in local:
         f = os.path.join(MAPPINGS, '{}.json'.format(title))
         mappings[title] = utils.load_json(f)
+    for title in ["languages", "places", "publishers"]:
+        mappings[title] = utils.MappingTable(mappings[title])
     for title in remote:
-        data = utils.get_wd_items_using_prop(
-            mappings["properties"][title])
         if title in ["isbn_10", "isbn_13"]:
-            data = normalize_isbn_map(data)
-        mappings[title] = data
+            normalize = normalize_isbn
+        else:
+            normalize = None
+        mappings[title] = utils.get_wd_index_using_prop(
+            mappings["properties"][title], normalize)
     print("Loaded local mappings: {}.".format(", ".join(local)))
     print("Loaded remote mappings: {}.".format(", ".join(remote)))
     return mappings
@@ -78,7 +86,7 @@ def load_mapping_files():
 def get_from_uri(uri):
     """Load data from uri."""
     url = "https://libris.kb.se/{}/data.jsonld".format(uri)
-    return json.loads(requests.get(url).text)
+    return json.loads(http_cache.get_text(url))
 
 
 def get_lines_from_file(filepath):
@@ -87,49 +95,68 @@ def get_lines_from_file(filepath):
     return [x.strip() for x in content]
 
 
+def upload_edition(edition, data, problem_report, wikidata_site, upload):
+    """
+    Upload an edition and record it in the journal.
+
+    :param upload: "live" or "sandbox"
+    """
+    live = True if upload == "live" else False
+    uploader = Uploader(edition, repo=wikidata_site,
+                        live=live, edit_summary=EDIT_SUMMARY)
+    if "Q" in problem_report and problem_report["Q"] == "":
+        problem_report["Q"] = uploader.wd_item_q
+    try:
+        uploader.upload()
+        if live and uploader.data["upload"]:
+            upload_journal.get_journal().record(
+                "process_edition", get_uri(data), uploader.wd_item_q, data)
+    except pywikibot.data.api.APIError as e:
+        print(e)
+
+
+def is_uploaded(data, upload):
+    """Check if a post is already uploaded according to the journal."""
+    if upload != "live":
+        return False
+    if upload_journal.get_journal().done(get_uri(data), data):
+        print("{} is already uploaded.".format(get_uri(data)))
+        return True
+    return False
+
+
 def main(arguments):
     wikidata_site = utils.create_site_instance("wikidata", "wikidata")
     data_files = load_mapping_files()
     cache = {}
-    existing_editions = utils.get_wd_items_using_prop(
+    existing_editions = utils.get_wd_index_using_prop(
         data_files["properties"]["libris_uri"])
     if arguments.get("uri"):
         mode = "uri"
         data = get_from_uri(arguments.get("uri"))
+        if is_uploaded(data, arguments.get("upload")):
+            return
         edition = Edition(data, wikidata_site, data_files,
                           existing_editions, cache, mode)
         problem_report = edition.get_report()
         if arguments.get("upload"):
-            live = True if arguments["upload"] == "live" else False
-            uploader = Uploader(edition, repo=wikidata_site,
-                                live=live, edit_summary=EDIT_SUMMARY)
-            if "Q" in problem_report and problem_report["Q"] == "":
-                problem_report["Q"] = uploader.wd_item_q
-            try:
-                uploader.upload()
-            except pywikibot.data.api.APIError as e:
-                print(e)
+            upload_edition(edition, data, problem_report, wikidata_site,
+                           arguments["upload"])
     elif arguments.get("dir") and arguments.get("libris_list"):
         mode = "local"
-        available_files = list_available_files(arguments.get("dir"))
+        available_files = load_available_files(arguments.get("dir"))
         libris_list = get_lines_from_file(arguments["libris_list"])
-        for fname in available_files:
-            data = utils.load_json(fname)
+        for data in available_files:
             selibr = get_libris_id(data)
             if selibr and selibr in libris_list:
+                if is_uploaded(data, arguments.get("upload")):
+                    continue
                 edition = Edition(data, wikidata_site, data_files,
                                   existing_editions, cache, mode)
                 problem_report = edition.get_report()
                 if arguments.get("upload"):
-                    live = True if arguments["upload"] == "live" else False
-                    uploader = Uploader(edition, repo=wikidata_site,
-                                        live=live, edit_summary=EDIT_SUMMARY)
-                    if "Q" in problem_report and problem_report["Q"] == "":
-                        problem_report["Q"] = uploader.wd_item_q
-                    try:
-                        uploader.upload()
-                    except pywikibot.data.api.APIError as e:
-                        print(e)
+                    upload_edition(edition, data, problem_report,
+                                   wikidata_site, arguments["upload"])
 
 
 if __name__ == "__main__":
@@ -1,9 +1,15 @@
 #!/usr/bin/python
 # -*- coding: utf-8  -*-
+import os
+import sys
 import pywikibot
 import pywikibot.data.sparql as sparql
 import wikidataStuff.helpers as helpers
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "shared"))
+import wdqs_pages  # noqa: E402
+
 
 def sanitize_wdqs_result(data):
     """
@@ -46,6 +52,20 @@ def get_wd_items_using_prop(prop):
     The output is a dictionary of ID's and items
     that looks like this:
     {'4420': 'Q28936211', '2041': 'Q28933898'}
+
+    The result is kept in a local snapshot, see snapshot_cache.
+    """
+    return wdqs_pages.get_items_using_prop_cached(
+        prop, download_wd_items_using_prop)
+
+
+def download_wd_items_using_prop(prop):
+    """
+    Query WDQS for WD items that have some value of a unique ID.
+
+    Gets them all in a single query. Properties used by
+    too many items for that are downloaded in pages by
+    wdqs_pages instead.
     """
     items = {}
     print("WILL NOW DOWNLOAD WD ITEMS THAT USE " + prop)
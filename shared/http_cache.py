@@ -0,0 +1,272 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Persistent on-disk cache for Libris requests.
+
+Response bodies are stored content-addressed (by their
+SHA-1) in a directory shared by all the scripts, while
+a small sqlite index keeps track of which url maps to
+which body together with its ETag/Last-Modified
+validators. Recently fetched entries are served without
+any request at all; older ones are revalidated, so an
+unchanged record only costs a 304. When the cache grows
+over its size cap the least recently used entries are
+evicted.
+
+Shared by the scripts in Biblioteksdata2/ and importer/, which
+add shared/ to sys.path.
+
+Settings (environment variables):
+    BIBLIOTEKSDATA_CACHE          cache directory, or "off"
+                                  to disable caching
+    BIBLIOTEKSDATA_CACHE_SIZE     size cap in megabytes
+    BIBLIOTEKSDATA_CACHE_MAX_AGE  seconds during which an entry
+                                  is used without revalidation
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "biblioteksdata")
+MAX_SIZE = 2048
+MAX_AGE = 24 * 60 * 60
+EVICT_BATCH = 100
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+class HttpCache(object):
+    """A size-capped LRU cache of GET responses."""
+
+    def __init__(self, path=CACHE_DIR, max_size=MAX_SIZE, max_age=MAX_AGE):
+        """
+        Open (or create) a cache directory.
+
+        @param path: directory to keep the cache in
+        @type path: string
+        @param max_size: size cap of stored bodies, in megabytes
+        @type max_size: int
+        @param max_age: seconds during which an entry is
+                        served without revalidation
+        @type max_age: int
+        """
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.max_age = max_age
+        self.objects = os.path.join(path, "objects")
+        os.makedirs(self.objects, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(path, "index.sqlite"),
+                                  check_same_thread=False)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, url TEXT, digest TEXT, "
+            "etag TEXT, last_modified TEXT, "
+            "fetched REAL, accessed REAL);"
+            "CREATE TABLE IF NOT EXISTS objects ("
+            "digest TEXT PRIMARY KEY, size INTEGER);"
+            "CREATE INDEX IF NOT EXISTS entries_accessed "
+            "ON entries (accessed);"
+            "CREATE INDEX IF NOT EXISTS entries_digest "
+            "ON entries (digest);")
+        self.remove_orphans()
+
+    def object_path(self, digest):
+        """Get location of a stored body."""
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def read_object(self, digest):
+        """Read a stored body, or None if it's gone missing."""
+        try:
+            with open(self.object_path(digest), "rb") as f:
+                return f.read().decode("utf-8")
+        except OSError:
+            return None
+
+    def write_object(self, body):
+        """
+        Store a body under its content hash.
+
+        Identical bodies are only stored once.
+        """
+        data = body.encode("utf-8")
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?)",
+                            (digest, len(data)))
+            self.db.commit()
+        return digest
+
+    def release(self, digest):
+        """
+        Delete a stored body if no entry uses it any more.
+
+        Must be called with the lock held.
+        @return: number of bytes freed
+        """
+        in_use = self.db.execute(
+            "SELECT 1 FROM entries WHERE digest = ? LIMIT 1",
+            (digest,)).fetchone()
+        if in_use:
+            return 0
+        size = self.db.execute(
+            "SELECT size FROM objects WHERE digest = ?",
+            (digest,)).fetchone()
+        self.db.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+        try:
+            os.remove(self.object_path(digest))
+        except OSError:
+            pass
+        return size[0] if size else 0
+
+    def remove_orphans(self):
+        """Delete stored bodies that no entry uses."""
+        with self.lock:
+            orphans = self.db.execute(
+                "SELECT digest FROM objects WHERE digest NOT IN "
+                "(SELECT digest FROM entries)").fetchall()
+            for digest, in orphans:
+                self.release(digest)
+            self.db.commit()
+
+    def lookup(self, key):
+        """Get the index row of a cache key."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT digest, etag, last_modified, fetched "
+                "FROM entries WHERE key = ?", (key,)).fetchone()
+
+    def store(self, key, url, digest, etag, last_modified, fetched):
+        """
+        Record a url → body mapping and its validators.
+
+        The body the entry pointed to before is deleted if
+        nothing else uses it.
+        """
+        with self.lock:
+            old = self.db.execute("SELECT digest FROM entries WHERE key = ?",
+                                  (key,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, url, digest, etag, last_modified, fetched, time.time()))
+            if old and old[0] != digest:
+                self.release(old[0])
+            self.db.commit()
+
+    def touch(self, key, fetched=None):
+        """Mark an entry as recently used (and optionally revalidated)."""
+        with self.lock:
+            if fetched:
+                self.db.execute(
+                    "UPDATE entries SET accessed = ?, fetched = ? "
+                    "WHERE key = ?", (time.time(), fetched, key))
+            else:
+                self.db.execute("UPDATE entries SET accessed = ? "
+                                "WHERE key = ?", (time.time(), key))
+            self.db.commit()
+
+    def evict(self):
+        """
+        Drop least recently used entries until under the size cap.
+
+        The oldest entries are fetched a few at a time, so that
+        a full cache doesn't read its whole index on every store.
+        """
+        with self.lock:
+            total = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+            while total > self.max_size:
+                oldest = self.db.execute(
+                    "SELECT key, digest FROM entries "
+                    "ORDER BY accessed LIMIT ?", (EVICT_BATCH,)).fetchall()
+                if not oldest:
+                    break
+                for key, digest in oldest:
+                    if total <= self.max_size:
+                        break
+                    self.db.execute("DELETE FROM entries WHERE key = ?",
+                                    (key,))
+                    total -= self.release(digest)
+            self.db.commit()
+
+    def get(self, url, headers=None):
+        """
+        Get the body of url, using the cache when possible.
+
+        @param url: url to fetch
+        @type url: string
+        @param headers: request headers
+        @type headers: dictionary
+        @return: response text
+        """
+        headers = dict(headers or {})
+        key = hashlib.sha1("{}\n{}".format(
+            url, headers.get("Accept", "")).encode("utf-8")).hexdigest()
+        entry = self.lookup(key)
+        body = None
+        if entry:
+            digest, etag, last_modified, fetched = entry
+            body = self.read_object(digest)
+        if body is not None:
+            if time.time() - fetched < self.max_age:
+                self.touch(key)
+                return body
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        response = requests.get(url, headers=headers)
+        if response.status_code == 304 and body is not None:
+            self.touch(key, fetched=time.time())
+            return body
+        if response.status_code != 200:
+            return response.text
+        digest = self.write_object(response.text)
+        self.store(key, url, digest,
+                   response.headers.get("ETag"),
+                   response.headers.get("Last-Modified"),
+                   time.time())
+        self.evict()
+        return response.text
+
+
+def get_default_cache():
+    """Get the cache configured by the environment, or None if disabled."""
+    global _default_cache
+    path = os.environ.get("BIBLIOTEKSDATA_CACHE", CACHE_DIR)
+    if path.lower() == "off":
+        return None
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = HttpCache(
+                path,
+                int(os.environ.get("BIBLIOTEKSDATA_CACHE_SIZE", MAX_SIZE)),
+                int(os.environ.get("BIBLIOTEKSDATA_CACHE_MAX_AGE", MAX_AGE)))
+        return _default_cache
+
+
+def get_text(url, headers=None):
+    """
+    Download url, going through the shared cache if enabled.
+
+    @param url: url to fetch
+    @type url: string
+    @param headers: request headers
+    @type headers: dictionary
+    """
+    cache = get_default_cache()
+    if cache is None:
+        return requests.get(url, headers=headers).text
+    return cache.get(url, headers)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Local snapshots of identifier → item maps from Wikidata.
+
+Downloading every item that uses e.g. P5587 or P212 takes
+minutes, so the result is kept on disk, one file per
+property, in a directory shared by all the scripts. A
+snapshot younger than the maximum age is loaded from disk
+instead of querying WDQS. Refreshed snapshots are written
+to a temporary file and moved into place, so a crash or a
+parallel run never leaves a half-written snapshot behind.
+If a refresh fails, an older snapshot is used rather than
+nothing.
+
+Shared by the scripts in Biblioteksdata2/, importer/,
+process_refs/ and runeberg/, which add shared/ to sys.path.
+
+Settings (environment variables):
+    BIBLIOTEKSDATA_SNAPSHOTS         snapshot directory, or "off"
+                                     to always query WDQS
+    BIBLIOTEKSDATA_SNAPSHOT_MAX_AGE  seconds during which a
+                                     snapshot is used
+"""
+import os
+import pickle
+import threading
+import time
+
+SNAPSHOT_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                            "biblioteksdata", "snapshots")
+MAX_AGE = 6 * 60 * 60
+
+
+def get_settings():
+    """Get the snapshot directory and maximum age from the environment."""
+    path = os.environ.get("BIBLIOTEKSDATA_SNAPSHOTS", SNAPSHOT_DIR)
+    max_age = int(os.environ.get("BIBLIOTEKSDATA_SNAPSHOT_MAX_AGE", MAX_AGE))
+    if path.lower() == "off":
+        return None, max_age
+    return path, max_age
+
+
+def snapshot_path(path, name, suffix=".pickle"):
+    """Get location of a snapshot, or of a file derived from it."""
+    return os.path.join(path, name + suffix)
+
+
+def read_snapshot(filename):
+    """Load a snapshot, or None if it's missing or unreadable."""
+    try:
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+
+
+def write_snapshot(filename, data):
+    """Atomically replace a snapshot."""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+    with open(tmp, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def load(name, download):
+    """
+    Get data from a fresh snapshot, or download and save it.
+
+    @param name: name of the snapshot, e.g. a property
+    @type name: string
+    @param download: function without arguments that gets the data
+    @type download: function
+    """
+    path, max_age = get_settings()
+    if path is None:
+        return download()
+    filename = snapshot_path(path, name)
+    try:
+        age = time.time() - os.path.getmtime(filename)
+    except OSError:
+        age = None
+    if age is not None and age < max_age:
+        data = read_snapshot(filename)
+        if data is not None:
+            print("LOADED SNAPSHOT OF {} ({} MINUTES OLD)".format(
+                name, int(age // 60)))
+            return data
+    try:
+        data = download()
+    except Exception:
+        data = read_snapshot(filename) if age is not None else None
+        if data is None:
+            raise
+        print("FAILED TO REFRESH {}, USING SNAPSHOT FROM {} MINUTES "
+              "AGO".format(name, int(age // 60)))
+        return data
+    write_snapshot(filename, data)
+    return data
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Run a function over a long list in a pool of threads, in order.
+
+Unlike ThreadPoolExecutor.map, which submits the whole list
+at once, only a limited window of calls is in flight, so
+memory use does not grow with the length of the list. Every
+result that is handed on makes room for one more call.
+
+Used by harvester.py, xsearch.py and add_uri.py in
+Biblioteksdata2/, which add shared/ to sys.path.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ordered_map(func, iterable, workers, window):
+    """
+    Call func on every element, yielding in the order of the elements.
+
+    Yields (element, future) pairs. The future gives the
+    result of func(element) or raises its error; it may
+    still be running when it's yielded, so the caller
+    decides when to wait for it.
+
+    @param func: function taking a single element
+    @type func: function
+    @param iterable: elements to process
+    @type iterable: iterable
+    @param workers: number of threads
+    @type workers: int
+    @param window: max number of elements submitted but not yet yielded
+    @type window: int
+    """
+    remaining = iter(iterable)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for element in remaining:
+            pending.append((element, executor.submit(func, element)))
+            if len(pending) >= window:
+                break
+        while pending:
+            head = pending.popleft()
+            for element in remaining:
+                pending.append((element, executor.submit(func, element)))
+                break
+            yield head
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Append-only journal of edits made to Wikidata.
+
+Each successful edit is recorded as one line with the
+source identifier (e.g. a Libris URI or a VIAF ID),
+the target item and a hash of the uploaded content.
+Every line is flushed to disk before moving on, so after
+an interruption the journal tells exactly which work is
+done, and a rerun can skip it without any network calls.
+A line that was cut off by a crash is removed.
+
+All the scripts write to the same journal, by default
+~/.local/share/biblioteksdata/upload_journal.tsv, which
+can be changed with the BIBLIOTEKSDATA_JOURNAL environment
+variable.
+
+Shared by the scripts in Biblioteksdata2/ and importer/, which
+add shared/ to sys.path.
+"""
+import datetime
+import hashlib
+import json
+import os
+
+JOURNAL_FILE = os.path.join(os.path.expanduser("~"), ".local", "share",
+                            "biblioteksdata", "upload_journal.tsv")
+
+_default_journal = None
+
+
+def content_hash(content):
+    """
+    Hash json-like content independent of key order.
+
+    @param content: content of the edit
+    @type content: any json-serializable object
+    """
+    text = json.dumps(content, sort_keys=True, ensure_ascii=False,
+                      default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class UploadJournal(object):
+    """A local record of edits already made."""
+
+    def __init__(self, path=JOURNAL_FILE):
+        """
+        Load an existing journal, or start a new one.
+
+        @param path: journal file
+        @type path: string
+        """
+        self.path = path
+        self.entries = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(path):
+            return
+        complete = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                complete += len(line)
+                fields = line.decode("utf-8").rstrip("\n").split("\t")
+                if len(fields) != 5:
+                    continue
+                timestamp, tool, source, target, digest = fields
+                self.entries.setdefault((source, digest), set()).add(target)
+        if complete < os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(complete)
+
+    def done(self, source, content, target=None):
+        """
+        Check whether an edit is in the journal.
+
+        @param source: identifier of the source of the edit
+        @type source: string
+        @param content: content of the edit
+        @type content: any json-serializable object
+        @param target: item the edit was made to; if not given,
+                       an edit to any item counts
+        @type target: string
+        """
+        targets = self.entries.get((source, content_hash(content)))
+        if not targets:
+            return False
+        return target is None or target in targets
+
+    def record(self, tool, source, target, content):
+        """
+        Add an edit to the journal.
+
+        @param tool: name of the script making the edit
+        @type tool: string
+        @param source: identifier of the source of the edit
+        @type source: string
+        @param target: item the edit was made to
+        @type target: string
+        @param content: content of the edit
+        @type content: any json-serializable object
+        """
+        digest = content_hash(content)
+        line = "\t".join([datetime.datetime.now().isoformat(),
+                          tool, source, target or "", digest])
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries.setdefault((source, digest), set()).add(target or "")
+
+
+def get_journal():
+    """Get the journal configured by the environment."""
+    global _default_journal
+    if _default_journal is None:
+        _default_journal = UploadJournal(
+            os.environ.get("BIBLIOTEKSDATA_JOURNAL", JOURNAL_FILE))
+    return _default_journal
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Download all values of an identifier property from WDQS in pages.
+
+A single query for every item using e.g. P212, or for every
+given name, hits the 60 second timeout of WDQS. Instead,
+the items are split into ranges of their numeric ID
+(Q1-Q5000000, Q5000001-...), and each range is fetched as
+a separate query. The last range is open-ended, so new
+items are never missed. The pages are requested
+concurrently in the CSV format, which is much lighter than
+json, and every row is passed on as soon as it's read. A
+page that still fails is split in two and retried.
+
+Shared by the scripts in Biblioteksdata2/, importer/,
+process_refs/ and runeberg/, which add shared/ to sys.path.
+"""
+import csv
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import snapshot_cache
+
+WDQS = "https://query.wikidata.org/sparql"
+HEADERS = {"Accept": "text/csv",
+           "User-Agent": "Biblioteksdata (python-requests)"}
+PAGE_SIZE = 5000000
+LAST_PAGE = 140000000
+WORKERS = 4
+MAX_SPLITS = 6
+TIMEOUT = 90
+
+# ISBN-13, ISBN-10, Libris edition and Libris URI
+PAGED_PROPERTIES = {"P212", "P957", "P1182", "P5587"}
+
+ITEM = re.compile(r"^http://www\.wikidata\.org/entity/(Q[0-9]+)$")
+QUERY = ('SELECT DISTINCT ?item ?value WHERE {{ '
+         '{pattern} '
+         'BIND(xsd:integer(STRAFTER(STR(?item), "/entity/Q")) AS ?n) '
+         'FILTER(?n >= {low}{high}) }}')
+
+
+def make_query(pattern, low, high=None):
+    """
+    Build a query for the items in a range of numeric IDs.
+
+    @param pattern: graph pattern binding ?item and ?value
+    @type pattern: string
+    @param low: lowest numeric ID in the range
+    @type low: int
+    @param high: numeric ID after the range, or None for no limit
+    @type high: int
+    """
+    return QUERY.format(
+        pattern=pattern, low=low,
+        high=" && ?n < {}".format(high) if high is not None else "")
+
+
+def make_ranges(page_size=PAGE_SIZE, last=LAST_PAGE):
+    """Split the numeric IDs into ranges, the last one open-ended."""
+    starts = list(range(1, last, page_size))
+    return [(low, high) for low, high in
+            zip(starts, starts[1:] + [None])]
+
+
+def fetch_range(pattern, low, high, add):
+    """
+    Stream one range of results to a function.
+
+    WDQS reports a timeout that happens after it has started
+    sending results as text at the end of the response, so
+    every row is checked, and anything that isn't an item and
+    a value raises a ValueError rather than giving a page that
+    is silently cut short.
+
+    @param add: function called with the value and QID of each row
+    @type add: function
+    @return: number of rows read
+    """
+    response = requests.get(WDQS,
+                            params={"query": make_query(pattern, low, high)},
+                            headers=HEADERS, stream=True, timeout=TIMEOUT)
+    response.raise_for_status()
+    lines = response.iter_lines(decode_unicode=True)
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header != ["item", "value"]:
+        raise ValueError("Unexpected header: {}".format(header))
+    count = 0
+    for row in reader:
+        if not row:
+            # iter_lines gives an empty line when a chunk ends
+            # between the \r and \n of a CRLF line ending
+            continue
+        match = ITEM.match(row[0]) if len(row) == 2 else None
+        if not match:
+            raise ValueError("Unexpected row: {}".format(row))
+        if row[1]:
+            add(row[1], match.group(1))
+        count += 1
+    return count
+
+
+def fetch_range_or_split(pattern, low, high, add, splits=MAX_SPLITS):
+    """
+    Stream one range of results, splitting it if it fails.
+
+    An open-ended range is split at LAST_PAGE, or if that's
+    passed, at twice its start. Rows of a failed attempt that
+    were already read are simply added again.
+
+    @param splits: how many more times the range may be split
+    @type splits: int
+    """
+    try:
+        return fetch_range(pattern, low, high, add)
+    except (requests.exceptions.RequestException, csv.Error,
+            ValueError) as e:
+        if not splits:
+            raise
+        middle = low + ((high or max(LAST_PAGE, 2 * low)) - low) // 2
+        print("FAILED TO GET Q{}-Q{} ({}), SPLITTING".format(
+            low, high or "", e))
+        return (fetch_range_or_split(pattern, low, middle, add, splits - 1) +
+                fetch_range_or_split(pattern, middle, high, add, splits - 1))
+
+
+def harvest(pattern, add, workers=WORKERS, page_size=PAGE_SIZE):
+    """
+    Stream all results of a graph pattern to a function, in pages.
+
+    @param pattern: graph pattern binding ?item and ?value
+    @type pattern: string
+    @param add: function called with the value and QID of each row,
+                from several threads at once
+    @type add: function
+    @param workers: number of pages to request at once
+    @type workers: int
+    @param page_size: number of numeric IDs in each page
+    @type page_size: int
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_range_or_split,
+                                   pattern, low, high, add)
+                   for low, high in make_ranges(page_size)]
+        rows = sum(future.result() for future in futures)
+    print("READ {} ROWS IN {} PAGES".format(rows, len(futures)))
+
+
+def get_items_using_prop(prop, workers=WORKERS, page_size=PAGE_SIZE):
+    """
+    Get a value → QID map of all items with some value of prop.
+
+    @param prop: property, e.g. P212
+    @type prop: string
+    """
+    items = {}
+    harvest("?item wdt:{} ?value.".format(prop), items.__setitem__,
+            workers, page_size)
+    return items
+
+
+def get_items_using_prop_cached(prop, fallback):
+    """
+    Get a value → QID map of all items with some value of prop.
+
+    The map is kept in a local snapshot, see snapshot_cache.
+    Properties in PAGED_PROPERTIES, used by too many items to
+    get in one query, are downloaded in pages; for the others
+    fallback is called.
+
+    @param prop: property, e.g. P212
+    @type prop: string
+    @param fallback: function that downloads the map of a property
+        in a single query
+    @type fallback: function
+    """
+    def download():
+        if prop not in PAGED_PROPERTIES:
+            return fallback(prop)
+        print("WILL NOW DOWNLOAD WD ITEMS THAT USE {} IN PAGES".format(prop))
+        items = get_items_using_prop(prop)
+        print("FOUND {} WD ITEMS WITH PROP {}".format(len(items), prop))
+        return items
+    return snapshot_cache.load(prop, download)
+
+
+def get_unique_values(pattern, normalize=None, workers=WORKERS,
+                      page_size=PAGE_SIZE):
+    """
+    Get a value → QID map of the values that only one item has.
+
+    Values shared by several items are left out.
+
+    @param pattern: graph pattern binding ?item and ?value
+    @type pattern: string
+    @param normalize: function applied to every value
+    @type normalize: function
+    """
+    items = {}
+    shared = set()
+    lock = threading.Lock()
+
+    def add(value, qid):
+        if normalize is not None:
+            value = normalize(value)
+        with lock:
+            if value in shared:
+                return
+            if items.setdefault(value, qid) != qid:
+                del items[value]
+                shared.add(value)
+
+    harvest(pattern, add, workers, page_size)
+    return items
+
+
+def get_items_by_value(pattern, workers=WORKERS, page_size=PAGE_SIZE):
+    """
+    Get a value → set of QIDs map of all results of a pattern.
+
+    Unlike get_unique_values, values shared by several
+    items are kept, with all their items.
+
+    @param pattern: graph pattern binding ?item and ?value
+    @type pattern: string
+    """
+    items = {}
+    lock = threading.Lock()
+
+    def add(value, qid):
+        with lock:
+            items.setdefault(value, set()).add(qid)
+
+    harvest(pattern, add, workers, page_size)
+    return items
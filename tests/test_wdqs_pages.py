@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""Unit tests for wdqs_pages."""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "shared"))
+import wdqs_pages  # noqa: E402
+
+
+class FakeResponse(object):
+    """A streamed response, split into chunks like requests does."""
+
+    def __init__(self, body, chunk_size):
+        self.body = body.encode("utf-8")
+        self.chunk_size = chunk_size
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def iter_lines(self, decode_unicode=False):
+        """Same logic as requests.Response.iter_lines."""
+        pending = None
+        for chunk in self.iter_content(self.chunk_size):
+            if decode_unicode:
+                chunk = chunk.decode("utf-8")
+            if pending is not None:
+                chunk = pending + chunk
+            lines = chunk.splitlines()
+            if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+                pending = lines.pop()
+            else:
+                pending = None
+            for line in lines:
+                yield line
+        if pending is not None:
+            yield pending
+
+
+def make_body(rows):
+    lines = ["item,value"]
+    for i in range(1, rows + 1):
+        lines.append("http://www.wikidata.org/entity/Q{},978-{}".format(i, i))
+    return "\r\n".join(lines) + "\r\n"
+
+
+class TestFetchRange(unittest.TestCase):
+
+    def fetch(self, body, chunk_size=512):
+        items = {}
+        response = FakeResponse(body, chunk_size)
+        with mock.patch.object(wdqs_pages.requests, "get",
+                               return_value=response):
+            count = wdqs_pages.fetch_range("?item wdt:P212 ?value.",
+                                           1, 10, items.__setitem__)
+        return count, items
+
+    def test_fetch_range_crlf_split_across_chunks(self):
+        body = make_body(5000)
+        # make sure some chunk really ends between \r and \n
+        ends = range(512, len(body), 512)
+        self.assertTrue(any(body[i - 1:i + 1] == "\r\n" for i in ends))
+        count, items = self.fetch(body)
+        self.assertEqual(count, 5000)
+        self.assertEqual(items["978-1"], "Q1")
+        self.assertEqual(items["978-5000"], "Q5000")
+
+    def test_fetch_range_error_trailer(self):
+        body = make_body(10) + (
+            "SPARQL-QUERY: queryStr=...\r\n"
+            "java.util.concurrent.TimeoutException\r\n")
+        with self.assertRaises(ValueError):
+            self.fetch(body)
+
+    def test_fetch_range_unexpected_header(self):
+        with self.assertRaises(ValueError):
+            self.fetch("error\r\n")